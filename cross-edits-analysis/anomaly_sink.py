@@ -0,0 +1,129 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 6/29/2020
+    Buffered writer for anomalies found by the sliding window analysis. Anomalies are
+    kept in memory as records and written in large batches, either as the sentences
+    described in the README or in a structured format (JSON lines or CSV).
+
+'''
+import csv
+import io
+import json
+import pandas as pd
+
+# Fields of an anomaly record, in order.
+FIELDS = ["key", "column", "metric", "start", "end", "percent_diff"]
+
+# Supported output formats and the extension of their log files.
+FORMAT_EXTENSIONS = {"text": "txt", "jsonl": "jsonl", "csv": "csv"}
+
+TEXT_TEMPLATE = ("Anomaly of {} of {} detected for {} during period from {} to {}, "
+                 "with a {:.2f} percent difference from baseline.\n")
+
+def format_timestamp(timestamp):
+    '''Render a timestamp for text log lines. Timestamps are kept as epoch seconds in
+    memory and shown as UTC date-times, matching the original log format.'''
+    if isinstance(timestamp, pd.Timestamp):
+        return str(timestamp)
+    return str(pd.Timestamp(int(timestamp), unit="s"))
+
+def _epoch_seconds(timestamp):
+    if isinstance(timestamp, pd.Timestamp):
+        return int(timestamp.timestamp())
+    return int(timestamp)
+
+class AnomalySink:
+    '''
+        Anomaly Sink Class. Buffers anomaly records and writes them to a log file in batches.
+        Instance Variables:
+            log_file: the file object records are written to.
+            out_format: one of "text", "jsonl" or "csv".
+            batch_size: number of buffered records that triggers a write.
+            records: the buffered records, as tuples of FIELDS.
+        Public Methods:
+            add: buffers a single anomaly.
+            extend: buffers a sequence of anomaly records.
+            add_frame: buffers the anomalies of a DataFrame with FIELDS columns.
+            flush: writes all buffered records in a single write call.
+            close: flushes and closes the log file.
+    '''
+
+    def __init__(self, log_file, out_format="text", batch_size=10000):
+        if out_format not in FORMAT_EXTENSIONS:
+            raise ValueError("Unknown anomaly log format {}".format(out_format))
+        self.log_file = log_file
+        self.out_format = out_format
+        self.batch_size = batch_size
+        self.records = []
+        self._header_written = False
+
+    def add(self, key, column, metric, start, end, percent_diff):
+        '''Buffer one anomaly: the window from start to end of the given key deviates
+        from the baseline of metric of column by percent_diff percent.'''
+        self.records.append((key, column, metric, start, end, percent_diff))
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def extend(self, records):
+        '''Buffer a sequence of records, each a tuple of FIELDS.'''
+        self.records.extend(records)
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def add_frame(self, anomalies):
+        '''Buffer the rows of a DataFrame holding the FIELDS columns.'''
+        self.extend(anomalies[FIELDS].itertuples(index=False, name=None))
+
+    def _format_text(self):
+        return "".join(TEXT_TEMPLATE.format(metric, column, key, format_timestamp(start),
+                                            format_timestamp(end), percent_diff)
+                       for key, column, metric, start, end, percent_diff in self.records)
+
+    def _format_jsonl(self):
+        return "".join(json.dumps({"key": str(key), "column": column, "metric": metric,
+                                   "start": _epoch_seconds(start),
+                                   "end": _epoch_seconds(end),
+                                   "percent_diff": round(float(percent_diff), 4)}) + "\n"
+                       for key, column, metric, start, end, percent_diff in self.records)
+
+    def _format_csv(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        if not self._header_written:
+            writer.writerow(FIELDS)
+            self._header_written = True
+        writer.writerows((key, column, metric, _epoch_seconds(start), _epoch_seconds(end),
+                          "{:.4f}".format(percent_diff))
+                         for key, column, metric, start, end, percent_diff in self.records)
+        return buffer.getvalue()
+
+    def flush(self):
+        '''Write every buffered record with a single write call.'''
+        if not self.records:
+            return
+        if self.out_format == "text":
+            text = self._format_text()
+        elif self.out_format == "jsonl":
+            text = self._format_jsonl()
+        else:
+            text = self._format_csv()
+        self.log_file.write(text)
+        self.records = []
+
+    def close(self):
+        '''Flush the remaining records and close the log file.'''
+        self.flush()
+        self.log_file.close()
@@ -37,30 +37,35 @@ def main(argv):
     article_analysis_engine.set_key("article", "title")
     article_analysis_engine.open_log_file()
     article_analysis_engine.display_aggregate_stats()
-    #article_analysis_engine.iterate_per_key(article_analysis_engine.display_per_group_stats)
-    #article_analysis_engine.iterate_per_key(article_analysis_engine.plot_evolution_across_time)
-    article_analysis_engine.iterate_per_key(article_analysis_engine.sliding_window_analysis)
-
-    articles_with_non_zero_scores = []
-    means = dict()
-    medians = dict()
-    columns = article_analysis_engine.columns_to_count
-
-    for column in columns:
-        means[column] = []
-        medians[column] = []
-
-    def compute_mean_and_median_non_zero(group, group_key, index):
-        # Get the edits with non-zero ores score for time-series analysis
-        non_zero_articles = group.loc[group["ores_damaging"] != 0].copy()
-        non_zero_count = non_zero_articles.shape[0]
-        if non_zero_count != 0:
-            articles_with_non_zero_scores.append(article)
-            for column in columns_to_count:
-                means[column].append(non_zero_articles[column].mean())
-                medians[column].append(non_zero_articles[column].median())
-
-    article_analysis_engine.iterate_per_key(compute_mean_and_median_non_zero)
+    if article_analysis_engine.stream:
+        # Streaming mode keeps per-key statistics of the non-zero edits instead of
+        # the full data, so the per-key tasks are not available.
+        columns = article_analysis_engine.columns_to_count
+        means = dict()
+        medians = dict()
+        for column in columns:
+            key_frame = article_analysis_engine.key_stats[column].to_frame()
+            means[column] = list(key_frame["mean"])
+            medians[column] = list(key_frame["median"])
+    else:
+        #article_analysis_engine.iterate_per_key(article_analysis_engine.display_per_group_stats)
+        #article_analysis_engine.iterate_per_key(article_analysis_engine.plot_evolution_across_time)
+        if article_analysis_engine.state_path:
+            article_analysis_engine.update_window_anomalies()
+        else:
+            article_analysis_engine.detect_window_anomalies()
+        if article_analysis_engine.time_window:
+            article_analysis_engine.detect_time_window_anomalies()
+
+        means = dict()
+        medians = dict()
+        columns = article_analysis_engine.columns_to_count
+        # Mean and median of the edits with non-zero ores score of every article
+        key_stats = article_analysis_engine.aggregate_stats(by_key=True, non_zero_only=True)
+        for column in columns:
+            column_stats = key_stats[key_stats["column"] == column]
+            means[column] = list(column_stats["mean"])
+            medians[column] = list(column_stats["median"])
 
     # Distribution of mean and median scores across articles
     fig, axes = plt.subplots(2, len(columns))
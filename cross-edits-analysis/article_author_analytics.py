@@ -18,4 +18,63 @@
     Script to perform article-author pair analytics, as outlined in part III of Preliminary Data
     Analysis Planning.
 
-'''
\ No newline at end of file
+'''
+import sys
+import matplotlib.pyplot as plt
+import numpy as np
+import co_edit
+import engine
+import os
+
+
+def main(argv):
+    '''Main routine to load files, compute article-author pair statistics and find author
+    pairs that repeatedly co-edit the same articles.'''
+
+    pair_analysis_engine = engine.Engine()
+    pair_analysis_engine.get_command_line_input(argv)
+    if pair_analysis_engine.stream:
+        print("Article-author analysis needs the loaded dataset and does not support --stream")
+        sys.exit(2)
+    # Anonymous edits are attributed to their ip, like in the author analysis.
+    pair_analysis_engine.set_key("author", "author")
+    pair_analysis_engine.fill_in_missing_key()
+    analyzer = co_edit.CoEditAnalyzer(pair_analysis_engine.df,
+                                      pair_analysis_engine.columns_to_count)
+    input_name = pair_analysis_engine.input_name()
+    os.makedirs("./log/combined", exist_ok=True)
+    os.makedirs("./graphs/combined", exist_ok=True)
+
+    with pair_analysis_engine.profiler.stage("pair_stats", analyzer.df.shape[0]):
+        pair_stats = analyzer.pair_stats()
+    print("{} article-author pairs among {} articles and {} authors".format(
+        pair_stats.shape[0], len(analyzer.articles), len(analyzer.authors)))
+    pair_stats.to_csv("./log/combined/article_author_pairs_{}.csv".format(input_name), index=False)
+
+    with pair_analysis_engine.profiler.stage("co_edit_pairs", analyzer.df.shape[0]):
+        co_edit_pairs = analyzer.co_edit_pairs(pair_analysis_engine.co_edit_window,
+                                               pair_analysis_engine.min_shared_articles)
+    print("{} author pairs co-edited at least {} articles within {} seconds".format(
+        co_edit_pairs.shape[0], pair_analysis_engine.min_shared_articles,
+        pair_analysis_engine.co_edit_window))
+    co_edit_pairs.to_csv("./log/combined/co_edit_pairs_window_{}_{}.csv".format(
+        pair_analysis_engine.co_edit_window, input_name), index=False)
+
+    # Distribution of edits per article-author pair and of articles per co-editing pair
+    fig, axes = plt.subplots(1, 2)
+    fig.set_size_inches(18.5, 10.5)
+    axes[0].hist(pair_stats["edit_count"], bins=np.arange(1, pair_stats["edit_count"].max() + 2),
+                 log=True)
+    axes[0].set_title("Edits per article-author pair")
+    if co_edit_pairs.shape[0] > 0:
+        axes[1].hist(co_edit_pairs["shared_articles"],
+                     bins=np.arange(pair_analysis_engine.min_shared_articles,
+                                    co_edit_pairs["shared_articles"].max() + 2), log=True)
+    axes[1].set_title("Co-edited articles per author pair")
+    plt.savefig("./graphs/combined/Pair_distributions.png")
+    plt.close()
+
+    pair_analysis_engine.cleanup()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
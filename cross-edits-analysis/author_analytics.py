@@ -36,31 +36,41 @@ def main(argv):
     author_analysis_engine.get_command_line_input(argv)
     author_analysis_engine.set_key("author", "author")
     author_analysis_engine.open_log_file()
-    author_analysis_engine.display_aggregate_stats()
-    #author_analysis_engine.iterate_per_key(author_analysis_engine.display_per_group_stats)
-    #author_analysis_engine.iterate_per_key(author_analysis_engine.plot_evolution_across_time)
-    author_analysis_engine.iterate_per_key(author_analysis_engine.sliding_window_analysis)
-
-    authors_with_non_zero_scores = []
-    means = dict()
-    medians = dict()
-    columns = author_analysis_engine.columns_to_count
-
-    for column in columns:
-        means[column] = []
-        medians[column] = []
-
-    def compute_mean_and_median_non_zero(group, group_key, index):
-        # Get the edits with non-zero ores score for time-series analysis
-        non_zero_authors = group.loc[group["ores_damaging"] != 0].copy()
-        non_zero_count = non_zero_authors.shape[0]
-        if non_zero_count != 0:
-            authors_with_non_zero_scores.append(group_key)
-            for column in columns:
-                means[column].append(group[column].mean())
-                medians[column].append(group[column].median())
-
-    author_analysis_engine.iterate_per_key(compute_mean_and_median_non_zero)
+    author_analysis_engine.display_aggregate_stats(key_non_zero_only=False)
+    if author_analysis_engine.stream:
+        # Streaming mode keeps per-key statistics of all edits instead of the full
+        # data, so the per-key tasks are not available.
+        columns = author_analysis_engine.columns_to_count
+        means = dict()
+        medians = dict()
+        for column in columns:
+            key_frame = author_analysis_engine.key_stats[column].to_frame()
+            # Like in memory, only authors with non-zero ores scores are counted.
+            non_zero_count = author_analysis_engine.key_non_zero_count.reindex(
+                key_frame.index, fill_value=0)
+            key_frame = key_frame[non_zero_count.to_numpy() != 0]
+            means[column] = list(key_frame["mean"])
+            medians[column] = list(key_frame["median"])
+    else:
+        #author_analysis_engine.iterate_per_key(author_analysis_engine.display_per_group_stats)
+        #author_analysis_engine.iterate_per_key(author_analysis_engine.plot_evolution_across_time)
+        if author_analysis_engine.state_path:
+            author_analysis_engine.update_window_anomalies()
+        else:
+            author_analysis_engine.detect_window_anomalies()
+        if author_analysis_engine.time_window:
+            author_analysis_engine.detect_time_window_anomalies()
+
+        means = dict()
+        medians = dict()
+        columns = author_analysis_engine.columns_to_count
+        # Mean and median of all edits of every author with non-zero ores scores
+        key_stats = author_analysis_engine.aggregate_stats(by_key=True)
+        key_stats = key_stats[key_stats["non_zero_count"] != 0]
+        for column in columns:
+            column_stats = key_stats[key_stats["column"] == column]
+            means[column] = list(column_stats["mean"])
+            medians[column] = list(column_stats["median"])
 
     # Distribution of mean and median scores across authors
     fig, axes = plt.subplots(2, len(columns))
@@ -0,0 +1,222 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/8/2020
+    Benchmark of the loader and engine hot paths on synthetic revision dumps. Generates
+    json lines segments in the schema of the real data, with a configurable number of
+    rows, keys and skew of group sizes, then times loading, group dispatch, sliding
+    window detection and aggregate statistics.
+
+    Usage:
+    $ python3 benchmark.py --rows 1000000 --articles 50000 --authors 100000 --skew 1.2
+
+'''
+
+import sys
+import getopt
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import anomaly_sink
+import engine
+import profiler
+
+def _zipf_codes(rng, size, key_count, skew):
+    '''Draw key codes in [0, key_count) whose frequencies follow a Zipf law with the
+    given exponent. A skew of 0 gives uniform group sizes.'''
+    weights = 1.0 / np.power(np.arange(1, key_count + 1), skew)
+    return rng.choice(key_count, size=size, p=weights / weights.sum())
+
+def generate_segments(out_dir, rows, articles, authors, skew=1.0, segments=8, seed=0):
+    '''Write `rows` synthetic revisions to `segments` json lines files in out_dir, and
+    return the path pattern of the files in the "##" placeholder format of the loader.
+    Revisions of an article stay in one segment, like in the real dumps. About 85% of
+    the revisions have zero ORES scores and 20% are anonymous.'''
+    rng = np.random.default_rng(seed)
+    page_ids = _zipf_codes(rng, rows, articles, skew)
+    author_ids = _zipf_codes(rng, rows, authors, skew)
+    anonymous = rng.random(rows) < 0.2
+    scored = rng.random(rows) < 0.15
+    damaging = np.where(scored, np.round(rng.beta(0.5, 8.0, rows), 3), 0.0)
+    goodfaith = np.where(scored, np.round(1.0 - rng.beta(0.5, 8.0, rows), 3), 0.0)
+    frame = pd.DataFrame({
+        "site_id": "http://en.wikipedia.org/",
+        "page_id": page_ids,
+        "title": np.char.add("Article ", page_ids.astype(str)),
+        "url": np.char.add("http://en.wikipedia.org/wiki/Article_", page_ids.astype(str)),
+        "revision_id": rng.permutation(rows) + 100000000,
+        "timestamp": rng.integers(1420070400, 1590969600, rows),
+        "author": np.where(anonymous, "", np.char.add("Editor ", author_ids.astype(str))),
+        "ip": np.where(anonymous, np.char.add("10.0.", author_ids.astype(str)), ""),
+        "is_bot": False,
+        "ores_damaging": damaging,
+        "ores_goodfaith": goodfaith})
+
+    file_path_format_str = os.path.join(out_dir, "segment-000##-of-{:05d}.json".format(segments))
+    segment_of_row = page_ids % segments
+    for segment in range(segments):
+        file_name = file_path_format_str.replace("##", "{:02d}".format(segment))
+        frame[segment_of_row == segment].to_json(file_name, orient="records", lines=True)
+    return file_path_format_str
+
+def _reset_peak_rss():
+    '''Reset the peak resident set size of this process to its current size, so that
+    the peak of a single stage can be read afterwards. Returns False where the kernel
+    does not support it.'''
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    '''Peak resident set size of this process since the last reset, in megabytes.
+    Falls back to the peak over the whole run where /proc is not available.'''
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _timed(results, name, rows, function):
+    '''Run function, recording wall time, throughput, the resident set size after the
+    stage and its peak during the stage under name. Without a peak reset, the peak of a
+    stage is only known if the stage raised the peak of the run; it is None otherwise.'''
+    run_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    reset = _reset_peak_rss()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    peak = _peak_rss_mb()
+    if not reset and peak <= run_peak:
+        peak = None
+    results.append({"stage": name, "seconds": round(seconds, 4),
+                    "rows_per_second": round(rows / seconds) if seconds > 0 else None,
+                    "rss_mb": round(profiler.current_rss_mb(), 1),
+                    "peak_rss_mb": None if peak is None else round(peak, 1)})
+
+def run_benchmark(file_path_format_str, segments, key="article", workers=1):
+    '''Time the hot paths on the given segments and return one result per stage.'''
+    results = []
+    key_column_name = "title" if key == "article" else "author"
+    bench_engine = engine.Engine()
+    args = ["--path", file_path_format_str, "--start", "0", "--stop", str(segments),
+            "--workers", str(workers), "--no-cache"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        _timed(results, "load", 0, lambda: bench_engine.get_command_line_input(args))
+    rows = bench_engine.df.shape[0]
+    results[-1]["rows_per_second"] = round(rows / results[-1]["seconds"])
+
+    bench_engine.set_key(key, key_column_name)
+    bench_engine.anomaly_sink = anomaly_sink.AnomalySink(io.StringIO())
+    bench_engine.window_log_file = bench_engine.anomaly_sink.log_file
+    _timed(results, "group_index", rows, bench_engine.build_group_index)
+    _timed(results, "group_dispatch", rows,
+           lambda: bench_engine.iterate_per_key(lambda group, group_key, index: None))
+    _timed(results, "window_detection", rows, bench_engine.detect_window_anomalies)
+
+    # display_aggregate_stats saves its histogram under ./graphs/aggregate.
+    current_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as graph_dir:
+        os.makedirs(os.path.join(graph_dir, "graphs", "aggregate"))
+        os.chdir(graph_dir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                _timed(results, "aggregate_stats", rows, bench_engine.display_aggregate_stats)
+        finally:
+            os.chdir(current_dir)
+    # cleanup prints the timings of the engine's own profiler; the stages above are
+    # reported by main instead.
+    with contextlib.redirect_stdout(io.StringIO()):
+        bench_engine.cleanup()
+    return rows, bench_engine.group_count, results
+
+def main(argv):
+    '''Generate a synthetic dump, run the benchmark and print the results.'''
+    rows, articles, authors, skew, segments = 200000, 20000, 40000, 1.0, 8
+    key, workers, seed, data_dir, json_path = "article", 1, 0, "", ""
+    try:
+        opts, _ = getopt.getopt(argv, "", ["rows=", "articles=", "authors=", "skew=",
+                                           "segments=", "key=", "workers=", "seed=",
+                                           "data-dir=", "json="])
+    except getopt.GetoptError:
+        print("benchmark.py [--rows <revisions>] [--articles <articles>] [--authors <authors>] \
+            [--skew <zipf_exponent>] [--segments <files>] [--key <article|author>] \
+            [--workers <loader_processes>] [--seed <seed>] [--data-dir <dir>] \
+            [--json <result_file>]")
+        sys.exit(2)
+
+    for option, value in opts:
+        if option == "--rows":
+            rows = int(value)
+        elif option == "--articles":
+            articles = int(value)
+        elif option == "--authors":
+            authors = int(value)
+        elif option == "--skew":
+            skew = float(value)
+        elif option == "--segments":
+            segments = int(value)
+        elif option == "--key":
+            key = value
+        elif option == "--workers":
+            workers = int(value)
+        elif option == "--seed":
+            seed = int(value)
+        elif option == "--data-dir":
+            data_dir = value
+        elif option == "--json":
+            json_path = value
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        out_dir = data_dir or temp_dir
+        start = time.perf_counter()
+        # Generate in a child process so that the generated frame is not part of the
+        # memory reported for the stages.
+        with multiprocessing.get_context("fork").Pool(1) as pool:
+            file_path_format_str = pool.apply(generate_segments, (out_dir, rows, articles,
+                                                                  authors, skew, segments,
+                                                                  seed))
+        print("Generated {} revisions in {} segments in {:.2f}s".format(
+            rows, segments, time.perf_counter() - start))
+        loaded_rows, group_count, results = run_benchmark(file_path_format_str, segments,
+                                                          key, workers)
+
+    print("{} revisions loaded, {} {} groups".format(loaded_rows, group_count, key))
+    print("{:<18}{:>10}{:>16}{:>10}{:>14}".format("stage", "seconds", "rows/second",
+                                                 "RSS MB", "peak RSS MB"))
+    for result in results:
+        peak = "n/a" if result["peak_rss_mb"] is None else "{:.1f}".format(result["peak_rss_mb"])
+        print("{:<18}{:>10.3f}{:>16}{:>10.1f}{:>14}".format(result["stage"], result["seconds"],
+                                                            str(result["rows_per_second"]),
+                                                            result["rss_mb"], peak))
+    if json_path:
+        with open(json_path, "w") as json_file:
+            json.dump({"rows": loaded_rows, "groups": group_count, "key": key,
+                       "skew": skew, "results": results}, json_file, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
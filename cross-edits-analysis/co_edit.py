@@ -0,0 +1,170 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/17/2020
+    Article-author pair analysis. Builds a sparse article x author co-occurrence table
+    of the loaded revisions, and finds author pairs that repeatedly edit the same
+    articles within short time windows.
+
+'''
+import numpy as np
+import pandas as pd
+import temporal_index
+
+def _aggregate_triples(first, second, third, counts):
+    '''Sum the counts of equal (first, second, third) code triples. Returns the distinct
+    triples, sorted, and their summed counts.'''
+    if first.shape[0] == 0:
+        return first, second, third, counts
+    order = np.lexsort((third, second, first))
+    first, second, third, counts = first[order], second[order], third[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], (first[1:] != first[:-1]) |
+                                            (second[1:] != second[:-1]) |
+                                            (third[1:] != third[:-1])]))
+    return first[starts], second[starts], third[starts], np.add.reduceat(counts, starts)
+
+class CoEditAnalyzer:
+    '''
+        Co-Edit Analyzer Class. Analyses revisions by article and author together.
+        Revisions without a title or an author are ignored.
+        Instance Variables:
+            df: the revisions analysed, with title, author, timestamp and the columns
+                to count.
+            columns_to_count: ORES columns summarised per pair.
+            articles, authors: the distinct titles and authors, indexed by their codes.
+            article_codes, author_codes: the title and author code of every revision.
+            pair_budget: maximum number of candidate author pairs materialised at once
+                         while looking for co-edits.
+        Public Methods:
+            pair_stats: edit counts and ORES statistics of every (article, author) pair.
+            co_edit_pairs: author pairs that edit the same articles within a time window.
+    '''
+
+    def __init__(self, df, columns_to_count, pair_budget=5000000):
+        article_codes, articles = pd.factorize(df["title"])
+        author_codes, authors = pd.factorize(df["author"])
+        # Distinct values in code order; uniques of a categorical column are Categoricals,
+        # whose own categories may be in a different order.
+        self.articles = pd.Index(articles, dtype=object)
+        self.authors = pd.Index(authors, dtype=object)
+        keep = (article_codes >= 0) & (author_codes >= 0)
+        self.df = df[keep]
+        self.columns_to_count = list(columns_to_count)
+        self.article_codes = article_codes[keep]
+        self.author_codes = author_codes[keep]
+        self.pair_budget = pair_budget
+
+    def pair_stats(self):
+        '''Edit counts and ORES statistics of every (article, author) pair that occurs,
+        i.e. the non-zero cells of the article x author co-occurrence matrix. Pairs are
+        joined on a single int64 code per cell, so the matrix is never built densely.
+        Returns a DataFrame with columns article, author, edit_count, non_zero_count,
+        first_edit, last_edit and the mean of each column over the edits with non-zero
+        ores scores, sorted by decreasing edit count.'''
+        cells = self.article_codes.astype(np.int64) * len(self.authors) + self.author_codes
+        cell_codes, distinct_cells = pd.factorize(cells)
+        cell_count = len(distinct_cells)
+        non_zero = self.df["ores_damaging"].to_numpy() != 0
+        timestamps = self.df["timestamp"].to_numpy()
+
+        stats = {"article": pd.Categorical.from_codes(distinct_cells // len(self.authors),
+                                                      categories=self.articles),
+                 "author": pd.Categorical.from_codes(distinct_cells % len(self.authors),
+                                                     categories=self.authors),
+                 "edit_count": np.bincount(cell_codes, minlength=cell_count),
+                 "non_zero_count": np.bincount(cell_codes, weights=non_zero,
+                                               minlength=cell_count).astype(np.int64)}
+        first_edit = np.full(cell_count, np.iinfo(np.int64).max)
+        last_edit = np.full(cell_count, np.iinfo(np.int64).min)
+        np.minimum.at(first_edit, cell_codes, timestamps)
+        np.maximum.at(last_edit, cell_codes, timestamps)
+        stats["first_edit"] = first_edit
+        stats["last_edit"] = last_edit
+        for column in self.columns_to_count:
+            values = self.df[column].to_numpy(dtype=np.float64)
+            totals = np.bincount(cell_codes[non_zero], weights=values[non_zero],
+                                 minlength=cell_count)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                stats["mean_" + column] = totals / stats["non_zero_count"]
+        frame = pd.DataFrame(stats)
+        return frame.sort_values(["edit_count", "non_zero_count"], ascending=False,
+                                 kind="stable", ignore_index=True)
+
+    def _window_pairs(self, window):
+        '''Yield, in chunks of at most pair_budget candidates (or a single edit's), the
+        (earlier author, later author, article) codes of all pairs of edits of the same
+        article by different authors at most window seconds apart.'''
+        index = temporal_index.TemporalIndex(self.article_codes,
+                                             self.df["timestamp"].to_numpy(),
+                                             self.articles, np.arange(self.df.shape[0]))
+        authors = self.author_codes[index.rows]
+        # Edits are sorted by (article, timestamp), so the edits of the same article
+        # within the window before edit i are exactly the positions starts[i]:i.
+        starts = index.trailing_window_starts(window + 1)
+        lengths = np.arange(starts.shape[0]) - starts
+        cumulative = np.cumsum(lengths)
+        chunk_start = 0
+        while chunk_start < lengths.shape[0]:
+            done = cumulative[chunk_start - 1] if chunk_start > 0 else 0
+            chunk_end = max(int(np.searchsorted(cumulative, done + self.pair_budget, "right")),
+                            chunk_start + 1)
+            counts = lengths[chunk_start:chunk_end]
+            later = np.repeat(np.arange(chunk_start, chunk_end), counts)
+            first_of_edit = np.repeat(np.cumsum(counts) - counts, counts)
+            earlier = later - 1 - (np.arange(later.shape[0]) - first_of_edit)
+            different = authors[earlier] != authors[later]
+            yield (authors[earlier][different], authors[later][different],
+                   index.codes[later][different])
+            chunk_start = chunk_end
+
+    def co_edit_pairs(self, window, min_shared_articles=2):
+        '''Find author pairs that edit the same articles within window seconds of each
+        other. Only edits of the same article at most window seconds apart are ever
+        paired, so popular articles cost in proportion to their edit bursts rather than
+        to the square of their author count; candidates are processed in bounded chunks.
+        Returns a DataFrame with columns author_a, author_b, shared_articles (distinct
+        articles the pair co-edited), co_edits (pairs of edits within the window) and
+        example_article, for the pairs with at least min_shared_articles shared
+        articles, sorted by decreasing shared_articles and co_edits.'''
+        parts = []
+        for earlier, later, articles in self._window_pairs(window):
+            # Author pairs are unordered.
+            author_a, author_b = np.minimum(earlier, later), np.maximum(earlier, later)
+            parts.append(_aggregate_triples(author_a, author_b, articles,
+                                            np.ones(author_a.shape[0], dtype=np.int64)))
+        if parts:
+            author_a, author_b, articles, counts = _aggregate_triples(
+                *[np.concatenate([part[field] for part in parts]) for field in range(4)])
+        else:
+            author_a = author_b = articles = counts = np.zeros(0, dtype=np.int64)
+
+        # Triples are sorted by author pair, so each pair is a run of its articles.
+        starts = np.flatnonzero(np.concatenate([[author_a.shape[0] > 0],
+                                                (author_a[1:] != author_a[:-1]) |
+                                                (author_b[1:] != author_b[:-1])]))
+        shared_articles = np.diff(np.append(starts, author_a.shape[0]))
+        co_edits = np.add.reduceat(counts, starts) if starts.shape[0] else counts
+        repeated = shared_articles >= min_shared_articles
+        frame = pd.DataFrame({
+            "author_a": pd.Categorical.from_codes(author_a[starts][repeated],
+                                                  categories=self.authors),
+            "author_b": pd.Categorical.from_codes(author_b[starts][repeated],
+                                                  categories=self.authors),
+            "shared_articles": shared_articles[repeated],
+            "co_edits": co_edits[repeated],
+            "example_article": pd.Categorical.from_codes(articles[starts][repeated],
+                                                         categories=self.articles)})
+        return frame.sort_values(["shared_articles", "co_edits"], ascending=False,
+                                 kind="stable", ignore_index=True)
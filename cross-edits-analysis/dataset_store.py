@@ -0,0 +1,371 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/22/2020
+    Dataset store for many dated dumps. Segments of every dump are appended to one raw
+    file per column and registered in a manifest; analyses memory-map the column files
+    and open any subset of dumps without parsing json, sharing the OS page cache between
+    processes.
+
+    Usage:
+    $ python3 dataset_store.py --store ./data/store --path ./data/1023/segment-000##-of-00037.json --start 0 --stop 37
+    $ python3 dataset_store.py --store ./data/store
+    $ python3 article_analytics.py --store ./data/store --dumps 1023
+
+'''
+
+import sys
+import getopt
+import fcntl
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+import loader
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+LOCK_FILE = "lock"
+
+# Segment files are named <dump prefix>segment-<index>-of-<count>.json, e.g.
+# cross_edits_tmp_ttl=72_revisioninfo_20200605_1023_segment-00000-of-00037.json.
+SEGMENT_NAME = re.compile(r"^(?P<prefix>.*?)segment-(?P<index>\d+)-of-(?P<count>\d+)")
+DUMP_NAME = re.compile(r"revisioninfo_(?P<dump>\d{8}_\d{4})")
+
+def dump_name(file_name):
+    '''Name of the dump a segment file belongs to: the date and time of a dated dump
+    file name (e.g. 20200605_1023), otherwise the file name prefix before "segment-",
+    or the name of the directory holding the file.'''
+    base = os.path.basename(file_name)
+    dated = DUMP_NAME.search(base)
+    if dated:
+        return dated.group("dump")
+    segment = SEGMENT_NAME.match(base)
+    prefix = segment.group("prefix").rstrip("_-.") if segment else ""
+    return prefix or os.path.basename(os.path.dirname(os.path.abspath(file_name)))
+
+class DatasetStore:
+    '''
+        Dataset Store Class. Keeps the revisions of many dumps as append-only column files
+        in a directory:
+            manifest.json: the committed row count, column dtypes, string dictionary
+                           sizes, and the dumps with the row range of each segment.
+            <column>.bin: the values of a numeric column, or the int32 codes of a string
+                          column, of all segments back to back.
+            <column>.strings: the distinct strings of a string column, one json string
+                              per line, in order of their codes.
+        Files only grow; the manifest is replaced atomically after the data of a segment
+        is written, so readers only ever see whole segments, and bytes past the
+        committed row count, left by an interrupted writer, are overwritten by the next
+        one. Writers hold an exclusive lock on the store.
+        Instance Variables:
+            root: directory of the store.
+            manifest: the committed manifest.
+        Public Methods:
+            dumps: names of the registered dumps.
+            summary: segments and rows of each dump.
+            add_segment: appends a json segment of a dump.
+            add_files: appends json segments, naming their dumps after their file names.
+            open: memory-maps a subset of dumps as a DataFrame.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest = None
+        self._dictionaries = dict()
+        self._maps = dict()
+        self._read_manifest()
+
+    def _read_manifest(self):
+        '''(Re)load the committed manifest; an empty store has none yet.'''
+        try:
+            with open(self._path(MANIFEST_FILE)) as manifest_file:
+                self.manifest = json.load(manifest_file)
+        except FileNotFoundError:
+            self.manifest = {"version": MANIFEST_VERSION, "rows": 0, "columns": dict(),
+                             "strings": dict(), "dumps": []}
+        if self.manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError("{}: unsupported store version {}".format(
+                self.root, self.manifest.get("version")))
+        self._dictionaries = dict()
+        self._maps = dict()
+
+    def dumps(self):
+        '''Names of the registered dumps, in order of registration.'''
+        return [dump["name"] for dump in self.manifest["dumps"]]
+
+    def summary(self):
+        '''Number of segments and rows of each dump, as a DataFrame.'''
+        return pd.DataFrame({"dump": self.dumps(),
+                             "segments": [len(dump["segments"])
+                                          for dump in self.manifest["dumps"]],
+                             "rows": [sum(segment["rows"] for segment in dump["segments"])
+                                      for dump in self.manifest["dumps"]]},
+                            columns=["dump", "segments", "rows"])
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _dictionary(self, column):
+        '''The committed distinct strings of a string column, as an Index in code order.'''
+        if column not in self._dictionaries:
+            committed = self.manifest["strings"].get(column, {"count": 0, "bytes": 0})
+            strings = []
+            if committed["count"]:
+                with open(self._path(column + ".strings"), "rb") as strings_file:
+                    lines = strings_file.read(committed["bytes"]).splitlines()
+                strings = json.loads(b"[" + b",".join(lines) + b"]")
+            self._dictionaries[column] = pd.Index(strings, dtype=object)
+        return self._dictionaries[column]
+
+    def _write_manifest(self):
+        temp_path = self._path("{}.tmp{}".format(MANIFEST_FILE, os.getpid()))
+        with open(temp_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temp_path, self._path(MANIFEST_FILE))
+
+    @staticmethod
+    def _append(path, committed_bytes, data):
+        '''Write data at the committed end of an append-only file, dropping any bytes
+        an interrupted writer left past it.'''
+        with open(path, "ab+") as column_file:
+            column_file.truncate(committed_bytes)
+            column_file.write(data)
+            column_file.flush()
+            os.fsync(column_file.fileno())
+
+    def _append_strings(self, column, categorical):
+        '''Codes of a categorical in the store dictionary of column. Strings not yet in
+        the dictionary are appended to it.'''
+        categorical = categorical.remove_unused_categories()
+        dictionary = self._dictionary(column)
+        committed = self.manifest["strings"].get(column, {"count": 0, "bytes": 0})
+        remap = dictionary.get_indexer(categorical.categories)
+        new_strings = categorical.categories[remap < 0]
+        if len(new_strings):
+            remap[remap < 0] = np.arange(len(dictionary), len(dictionary) + len(new_strings))
+            lines = b"".join(json.dumps(str(string)).encode("utf-8") + b"\n"
+                             for string in new_strings)
+            self._append(self._path(column + ".strings"), committed["bytes"], lines)
+            self._dictionaries[column] = dictionary.append(pd.Index(new_strings,
+                                                                    dtype=object))
+            self.manifest["strings"][column] = {"count": committed["count"] + len(new_strings),
+                                                "bytes": committed["bytes"] + len(lines)}
+        # A trailing -1 maps the missing value code -1 to itself.
+        return np.append(remap, -1).astype(np.int32)[categorical.codes]
+
+    def _lock(self):
+        os.makedirs(self.root, exist_ok=True)
+        lock_file = open(self._path(LOCK_FILE), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def add_segment(self, dump, file_name, validate=False):
+        '''Append the revisions of a json segment to the store as part of dump. Segments
+        already registered for the dump are skipped; a registered segment whose file has
+        changed since raises ValueError, since stored segments are never rewritten.
+        Returns the number of rows appended.'''
+        with self._lock():
+            # Another writer may have committed since the manifest was read.
+            self._read_manifest()
+            entries = [entry for entry in self.manifest["dumps"] if entry["name"] == dump]
+            entry = entries[0] if entries else {"name": dump, "segments": []}
+            source = loader._source_signature(file_name)
+            for segment in entry["segments"]:
+                if segment["file"] == os.path.basename(file_name):
+                    if segment["source"] != source:
+                        raise ValueError("{}: segment of dump {} changed since it was "
+                                         "stored".format(file_name, dump))
+                    return 0
+
+            frame = loader._read_json_segment(file_name, loader.DEFAULT_COLUMNS,
+                                              loader.DEFAULT_DTYPES, validate=validate)
+            # Revisions repeated within a dump are stored once, keeping the first, so
+            # that a single dump opens without dropping rows.
+            if "revision_id" in frame.columns:
+                stored = self._dump_revisions(entry)
+                repeated = frame["revision_id"].duplicated().to_numpy() | \
+                           np.isin(frame["revision_id"].to_numpy(), stored)
+                if repeated.any():
+                    frame = frame[~repeated].reset_index(drop=True)
+            rows = frame.shape[0]
+            if rows:
+                self._append_frame(frame, file_name)
+            entry["segments"].append({"file": os.path.basename(file_name), "source": source,
+                                      "start": self.manifest["rows"], "rows": rows})
+            if not entries:
+                self.manifest["dumps"].append(entry)
+            self.manifest["rows"] += rows
+            self._write_manifest()
+            return rows
+
+    def _dump_revisions(self, entry):
+        '''Revision ids already stored for a dump entry of the manifest.'''
+        if "revision_id" not in self.manifest["columns"]:
+            return np.zeros(0, dtype=np.int64)
+        revision_ids = self._column("revision_id")
+        return np.concatenate([np.asarray(revision_ids[segment["start"]:
+                                                       segment["start"] + segment["rows"]])
+                               for segment in entry["segments"]] + [np.zeros(0, np.int64)])
+
+    def _append_frame(self, frame, file_name):
+        '''Append the columns of a parsed segment to the column files.'''
+        columns = self.manifest["columns"]
+        missing = [column for column in (columns or loader.DEFAULT_COLUMNS)
+                   if column not in frame.columns]
+        if missing:
+            raise ValueError("{}: missing fields {}".format(file_name, ", ".join(missing)))
+        committed_rows = self.manifest["rows"]
+        for column in loader.DEFAULT_COLUMNS:
+            if isinstance(frame[column].dtype, pd.CategoricalDtype):
+                values = self._append_strings(column, frame[column].array)
+                columns.setdefault(column, {"dtype": np.dtype(np.int32).str,
+                                            "strings": True})
+            else:
+                columns.setdefault(column, {"dtype": frame[column].to_numpy().dtype.str,
+                                            "strings": False})
+                values = frame[column].to_numpy(dtype=np.dtype(columns[column]["dtype"]))
+            itemsize = np.dtype(columns[column]["dtype"]).itemsize
+            self._append(self._path(column + ".bin"), committed_rows * itemsize,
+                         np.ascontiguousarray(values).tobytes())
+
+    def add_files(self, file_names, dump=None, validate=False):
+        '''Append json segments, in order. Each segment is registered under dump, or
+        under the dump named after its file name. Returns the number of rows appended.'''
+        return sum(self.add_segment(dump or dump_name(file_name), file_name, validate)
+                   for file_name in file_names)
+
+    def _row_ranges(self, dumps):
+        '''Row ranges of the segments of the given dumps, in store order, with adjacent
+        ranges merged.'''
+        known = set(self.dumps())
+        unknown = [dump for dump in dumps if dump not in known]
+        if unknown:
+            raise ValueError("{}: unknown dumps {}".format(self.root, ", ".join(unknown)))
+        ranges = sorted((segment["start"], segment["start"] + segment["rows"])
+                        for entry in self.manifest["dumps"] if entry["name"] in dumps
+                        for segment in entry["segments"] if segment["rows"])
+        merged = []
+        for start, end in ranges:
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+    def _column(self, column):
+        '''The committed values of a column file, memory-mapped read-only. A column is
+        mapped once per committed row count, so all frames opened meanwhile share the map.'''
+        values = self._maps.get(column)
+        if values is None or values.shape[0] != self.manifest["rows"]:
+            dtype = np.dtype(self.manifest["columns"][column]["dtype"])
+            if self.manifest["rows"] == 0:
+                values = np.zeros(0, dtype=dtype)
+            else:
+                values = np.memmap(self._path(column + ".bin"), dtype=dtype, mode="r",
+                                   shape=(self.manifest["rows"],))
+            self._maps[column] = values
+        return values
+
+    def open(self, dumps=None, columns=None, since=None, until=None):
+        '''Open the revisions of the given dumps (all dumps if None) as a DataFrame, like
+        Loader.load_json in concat mode: duplicated revisions are dropped, keeping the
+        first in store order, and only revisions with since <= timestamp < until are
+        kept. String columns become categoricals over the strings that occur.
+        Nothing is parsed or decoded. When the dumps are stored back to back and no row
+        is dropped, numeric columns are views of the memory-mapped column files, so
+        processes opening the same dumps share their pages. Raises ValueError if the
+        store holds no revisions yet.'''
+        if not self.manifest["columns"]:
+            raise ValueError("{}: the store holds no revisions; add dumps with "
+                             "dataset_store.py --store {} --path ...".format(self.root, self.root))
+        columns = list(columns or [column for column in loader.DEFAULT_COLUMNS
+                                   if column in self.manifest["columns"]])
+        ranges = self._row_ranges(self.dumps() if dumps is None else list(dumps))
+        if len(ranges) == 1:
+            rows = slice(*ranges[0])
+        else:
+            rows = np.concatenate([np.arange(start, end, dtype=np.int64)
+                                   for start, end in ranges] or [np.zeros(0, np.int64)])
+
+        keep = None
+        if "revision_id" in self.manifest["columns"]:
+            duplicated = pd.Series(self._column("revision_id")[rows]).duplicated().to_numpy()
+            if duplicated.any():
+                keep = ~duplicated
+        if since is not None or until is not None:
+            timestamps = self._column("timestamp")[rows]
+            in_range = np.ones(timestamps.shape[0], dtype=bool)
+            if since is not None:
+                in_range &= timestamps >= since
+            if until is not None:
+                in_range &= timestamps < until
+            keep = in_range if keep is None else keep & in_range
+
+        series = []
+        for column in columns:
+            values = self._column(column)[rows]
+            if keep is not None:
+                values = values[keep]
+            if self.manifest["columns"][column]["strings"]:
+                values = pd.Categorical.from_codes(
+                    values, categories=self._dictionary(column)).remove_unused_categories()
+            series.append(pd.Series(values, name=column, copy=False))
+        # Series are combined column by column: building the frame from a dict may
+        # consolidate columns of the same dtype into one block, copying them out of the
+        # column files.
+        return pd.concat(series, axis=1)
+
+def main(argv):
+    '''Append json segments to a store, then list the dumps it holds.'''
+    store_path, data_file_path, dump, validate = "", "", None, False
+    range_start, range_end = 0, 0
+    try:
+        opts, _ = getopt.getopt(argv, "", ["store=", "path=", "start=", "stop=", "dump=",
+                                           "validate"])
+    except getopt.GetoptError:
+        opts = None
+    if opts is None or not any(option == "--store" for option, _ in opts):
+        print("dataset_store.py --store <store_directory> \
+            [--path <pattern_of_path_to_data_files> --start <start_of_file_index_range> \
+            --stop <end_of_file_index_range>] [--dump <dump_name>] [--validate]")
+        sys.exit(2)
+
+    for option, value in opts:
+        if option == "--store":
+            store_path = value
+        elif option == "--path":
+            data_file_path = value
+        elif option == "--start":
+            range_start = int(value)
+        elif option == "--stop":
+            range_end = int(value)
+        elif option == "--dump":
+            dump = value
+        elif option == "--validate":
+            validate = True
+
+    store = DatasetStore(store_path)
+    if data_file_path:
+        file_names = loader.Loader()._get_file_names(data_file_path, range_start, range_end)
+        rows = store.add_files(file_names, dump, validate)
+        print("{} revisions appended from {} segments".format(rows, len(file_names)))
+    print(store.summary().to_string(index=False))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
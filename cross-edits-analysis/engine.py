@@ -21,10 +21,78 @@
 
 import sys
 import getopt
-#import pandas as pd
+import contextlib
+import cProfile
+import functools
+import io
+import multiprocessing
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import pandas as pd
 import matplotlib.pyplot as plt
+import anomaly_sink
+import dataset_store
 import loader
+import plotting
+import profiler
+import sketch
+import state_store
+import streaming
+import temporal_index
 import os
+import time
+
+# Engine and tasks of the running iterate_per_key call. Worker processes are forked
+# and inherit them, so neither the dataset nor the bound task methods are pickled.
+_worker_state = dict()
+
+def _profiled(stage_name):
+    '''Decorator recording an Engine method as a stage of the engine's profiler.'''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            rows = 0 if self.df is None else self.df.shape[0]
+            with self.profiler.stage(stage_name, rows):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def _run_operations(operations, group_frame, group_key, index):
+    '''Run every operation on one group. Returns their results and their wall times.'''
+    results = []
+    seconds = []
+    for operation in operations:
+        start = time.perf_counter()
+        results.append(operation(group_frame, group_key, index))
+        seconds.append(time.perf_counter() - start)
+    return results, seconds
+
+def _run_group_shard(shard):
+    '''Run the tasks of the current iterate_per_key call on a shard of group indices in
+    a worker process. Anomaly records, raw log lines and console output of every group
+    are captured so that the parent can replay them in group order.'''
+    engine = _worker_state["engine"]
+    out_format = engine.anomaly_sink.out_format if engine.anomaly_sink else "text"
+    operations = _worker_state["operations"]
+    sorted_df, group_keys, offsets = engine.group_index
+    shard_output = []
+    for index in shard:
+        group_frame = sorted_df.iloc[offsets[index]:offsets[index + 1]]
+        log_buffer = io.StringIO()
+        console_buffer = io.StringIO()
+        engine.window_log_file = log_buffer
+        # Records stay buffered in the worker and are handed back to the parent's sink.
+        engine.anomaly_sink = anomaly_sink.AnomalySink(log_buffer, out_format,
+                                                       batch_size=float("inf"))
+        with contextlib.redirect_stdout(console_buffer):
+            results, seconds = _run_operations(operations, group_frame, group_keys[index],
+                                               index)
+        shard_output.append((index, engine.anomaly_sink.records, log_buffer.getvalue(),
+                             console_buffer.getvalue(), results, seconds))
+    # Sheets of tiles are named after their first group, so those saved by different
+    # workers do not collide.
+    engine.finish_plots()
+    return shard_output
 
 class Engine:
     '''
@@ -39,25 +107,85 @@ class Engine:
             key: the key to group the dataset by
             key_column_name: name of the key column in string.
             group_count: number of groups
+            group_index: (sorted frame, group keys, group offsets) partition of the dataset by
+                         key, built once by build_group_index and reused by every task.
             anomaly_threshold: percentage threshold for anomaly. Used for sliding window analysis.
             window_log_file: log file for anomaly incidents identified. 
+            log_format: format of the anomaly log, one of "text", "jsonl" or "csv".
+            anomaly_sink: buffered AnomalySink writing anomalies to window_log_file.
+            time_window_sink: AnomalySink of the time window anomalies, which are logged
+                              apart from the fixed window ones.
+            workers: number of processes used to parse data files.
+            cache: use of the columnar segment cache, one of "use", "rebuild" or "off".
+            stream: if True, data files are read in chunks and never held in memory as a
+                    whole. Only the aggregate statistics are available in this mode.
+            chunk_size: number of records per chunk in streaming mode.
+            data_file_path: path pattern of the data files, kept for streaming mode.
+            store_path: DatasetStore directory the data is opened from instead of the data
+                        files, if not empty.
+            dumps: names of the dumps opened from the store. All dumps are opened if
+                   None; they are named once the store is opened.
+            key_stats: per-column KeyedStreamingStats of every key, filled in streaming mode.
+            key_non_zero_count: number of edits with non-zero ores scores of every key,
+                                filled in streaming mode.
+            fill_missing_key: True once fill_in_missing_key was called; streaming mode
+                              then fills in the keys of every chunk.
+            state_path: file of the per-key state used by incremental analysis. Empty if
+                        the analysis is not incremental.
+            plot_mode: how per-group figures are drawn: "figure" builds a new figure per
+                       group, "reuse" redraws a single figure and "tiles" draws tile_grid
+                       groups per sheet.
+            tile_grid: (rows, cols) of groups per sheet in "tiles" mode.
+            plot_limit: maximum number of groups that get figures, None for no limit.
+            plot_every: only every n-th group gets figures.
+            plotters: GroupPlotter of each plot kind in "reuse" and "tiles" modes.
+            profiler: StageProfiler timing every stage and per-key task. Its report is
+                      printed by cleanup.
+            profile_json_path: file the profiler report is also written to, if not empty.
+            cprofile_path: file the cProfile statistics of the whole run are written to,
+                           if not empty.
         Public Methods:
             get_command_line_input: provides a standardized command-line prompt for user.
+            input_name: names the analysed input in log file names.
             open_log_file: opens the required log file.
             display_aggregate_stats: shows the aggregate statistics of the dataset on command line.
+            display_aggregate_stats_streaming: same statistics computed chunk by chunk.
+            aggregate_stats: count, zero count, mean, median and std of every column, over
+                             the dataset or per key, as a tidy DataFrame.
             set_key: set the group-by key of the analysis Engine.
             fill_in_missing_key: automatically replaces empty keys.
+            build_group_index: partitions the dataset by key column.
             iterate_per_key: core method for analysis. Iterates any number of tasks across all 
                              groups. Each task must be a method that takes in 3 arguments: 
                              the group, the group-id and the group index (in all groups).
+                             Groups can be spread over several worker processes.
+            group_stats: statistics of a group as a dict.
             display_per_group_stats: a built-in task that prints each group's stats on console.
+            finish_plots: saves partially filled sheets of per-group figures.
             plot_evolution_over_time: a built-in task that plots the evolution of both scores
                                       against timestamp.
+            format_timestamp: renders an epoch-second timestamp the way log lines show it.
             sliding_window_analysis: a built-in task to perform sliding window analysis on a group.
                                      For detailed explanation as well as formula, see README.
-            cleanup: performs cleanup upon exiting.
+            detect_window_anomalies: vectorized sliding window analysis of all groups at once.
+                                     Flags the same windows as sliding_window_analysis.
+            update_window_anomalies: incremental sliding window analysis of newly loaded data
+                                     against the per-key state of earlier runs.
+            cleanup: performs cleanup upon exiting and reports the timings of the run.
     '''
 
+    # If multiplier is -1, then a higher value indicates an edit is "good" (less likely
+    # to be vandalism). If multiplier is 1, then a higher value indicates an edit
+    # is "bad" (more likely to be vandalism).
+    # This is because for columns where higher value is "good", we only watch for
+    # abnormally low values (we care less about the abnormally high values), 
+    # and for columns where higher value is "bad", we only watch for the 
+    # abnormally high values. 
+    column_diff_multiplier = {"ores_damaging": 1, "ores_goodfaith": -1}
+    # Number of edits in a sliding window. Groups with fewer non-zero edits fall back
+    # to windows of a single edit.
+    window_size = 10
+
     def __init__(self):
         self.df = None
         self.range_start = 0
@@ -67,18 +195,89 @@ class Engine:
         self.key = ""
         self.key_column_name = ""
         self.group_count = 0
+        self.group_index = None
         self.anomaly_threshold = 50 # >50% difference during window period is flagged as anomaly
         self.window_log_file = ""
+        self.log_format = "text"
+        self.anomaly_sink = None
+        self.time_window_sink = None
+        self.workers = 1
+        self.cache = "use"
+        # Check loaded records against the declared record schema of the loader.
+        self.validate = False
+        self.stream = False
+        self.chunk_size = 100000
+        self.data_file_path = ""
+        self.store_path = ""
+        self.dumps = None
+        self.key_stats = dict()
+        self.key_non_zero_count = pd.Series(dtype=np.int64)
+        self.fill_missing_key = False
+        self.state_path = ""
+        self.plot_mode = "figure"
+        self.tile_grid = (4, 4)
+        self.plot_limit = None
+        self.plot_every = 1
+        self.plotters = dict()
+        # Baseline medians of the sliding window analysis are "exact", or approximated
+        # with mergeable quantile sketches of compactor size sketch_k ("sketch").
+        self.median_mode = "exact"
+        self.sketch_k = 200
+        # Only revisions with since <= timestamp < until (epoch seconds) are loaded.
+        self.since = None
+        self.until = None
+        # Length in seconds of the trailing time windows, if they are analysed too.
+        self.time_window = None
+        self.temporal_index = None
+        self.group_positions = None
+        self.group_sizes = None
+        # Article-author analysis: edits of an article by two authors at most
+        # co_edit_window seconds apart are co-edits, and author pairs sharing at least
+        # min_shared_articles co-edited articles are reported.
+        self.co_edit_window = 86400
+        self.min_shared_articles = 2
+        # Address and result cache size of the query service.
+        self.host = "127.0.0.1"
+        self.port = 8080
+        self.cache_size = 256
+        self.profiler = profiler.StageProfiler()
+        self.profile_json_path = ""
+        self.cprofile_path = ""
+        self._cprofile = None
+        self._task_seconds = []
 
     def get_command_line_input(self, argv):
         '''Parse the command line input that specifies data file paths.'''
         data_file_path = ""
 
         try:
-            opts, _ = getopt.getopt(argv, "", ["path=", "start=", "stop="])
+            opts, _ = getopt.getopt(argv, "", ["path=", "start=", "stop=", "workers=",
+                                               "stream", "chunk-size=", "no-cache",
+                                               "rebuild-cache", "log-format=", "state=",
+                                               "plot-mode=", "plot-limit=", "plot-every=",
+                                               "profile-json=", "cprofile=", "slowest=",
+                                               "median=", "sketch-k=", "since=", "until=",
+                                               "time-window=", "co-edit-window=",
+                                               "min-shared-articles=", "validate", "host=",
+                                               "port=", "cache-size=", "store=", "dumps="])
         except getopt.GetoptError:
             print("article_analytics.py --path <pattern_of_path_to_data_files> --start \
-                <start_of_file_index_range> --end <end_of_file_index_range>")
+                <start_of_file_index_range> --end <end_of_file_index_range> \
+                [--workers <number_of_loader_processes>] \
+                [--stream] [--chunk-size <records_per_chunk>] \
+                [--no-cache | --rebuild-cache] [--log-format <text|jsonl|csv>] \
+                [--state <incremental_analysis_state_file>] \
+                [--plot-mode <figure|reuse|tiles>] [--plot-limit <max_groups_plotted>] \
+                [--plot-every <plot_every_nth_group>] [--profile-json <timings_file>] \
+                [--cprofile <stats_file>] [--slowest <slowest_groups_reported>] \
+                [--median <exact|sketch>] [--sketch-k <sketch_compactor_size>] \
+                [--since <first_time>] [--until <end_time>] \
+                [--time-window <window_length>] \
+                [--co-edit-window <window_length>] \
+                [--min-shared-articles <articles_per_author_pair>] [--validate] \
+                [--host <service_address>] [--port <service_port>] \
+                [--cache-size <cached_service_results>] \
+                [--store <dataset_store_directory> [--dumps <dump_names>]]")
             sys.exit(2)
 
         for option, value in opts:
@@ -86,39 +285,157 @@ class Engine:
                 data_file_path = value
             elif option == "--start":
                 self.range_start = int(value)
-            else:
+            elif option == "--stop":
                 self.range_end = int(value)
+            elif option == "--workers":
+                self.workers = int(value)
+            elif option == "--stream":
+                self.stream = True
+            elif option == "--chunk-size":
+                self.chunk_size = int(value)
+            elif option == "--no-cache":
+                self.cache = "off"
+            elif option == "--rebuild-cache":
+                self.cache = "rebuild"
+            elif option == "--log-format":
+                self.log_format = value
+            elif option == "--state":
+                self.state_path = value
+            elif option == "--plot-mode":
+                self.plot_mode = value
+            elif option == "--plot-limit":
+                self.plot_limit = int(value)
+            elif option == "--plot-every":
+                self.plot_every = int(value)
+            elif option == "--profile-json":
+                self.profile_json_path = value
+            elif option == "--cprofile":
+                self.cprofile_path = value
+            elif option == "--slowest":
+                self.profiler.slowest_count = int(value)
+            elif option == "--median":
+                self.median_mode = value
+            elif option == "--sketch-k":
+                self.sketch_k = int(value)
+            elif option == "--since":
+                self.since = temporal_index.parse_time(value)
+            elif option == "--until":
+                self.until = temporal_index.parse_time(value)
+            elif option == "--time-window":
+                self.time_window = temporal_index.parse_span(value)
+            elif option == "--co-edit-window":
+                self.co_edit_window = temporal_index.parse_span(value)
+            elif option == "--min-shared-articles":
+                self.min_shared_articles = int(value)
+            elif option == "--validate":
+                self.validate = True
+            elif option == "--host":
+                self.host = value
+            elif option == "--port":
+                self.port = int(value)
+            elif option == "--cache-size":
+                self.cache_size = int(value)
+            elif option == "--store":
+                self.store_path = value
+            elif option == "--dumps":
+                self.dumps = value.split(",")
 
         data_loader = loader.Loader()
         _, file_extension = os.path.splitext(data_file_path)
+        self.data_file_path = data_file_path
 
-        if file_extension == ".json":
-            data_loader.load_json(data_file_path, self.range_start, self.range_end)
-            self.df = data_loader.get_data() 
-        elif file_extension == ".csv":
-            data_loader.load_csv(data_file_path, self.range_start, self.range_end)
-            self.df = data_loader.get_data() 
-        else:
+        if self.cprofile_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        if self.store_path:
+            # Stored dumps are memory-mapped, so they are never streamed.
+            self.stream = False
+            with self.profiler.stage("load") as stage:
+                store = dataset_store.DatasetStore(self.store_path)
+                try:
+                    self.df = store.open(self.dumps, since=self.since, until=self.until)
+                except ValueError as error:
+                    print(error)
+                    sys.exit(2)
+                if self.dumps is None:
+                    self.dumps = store.dumps()
+                print("{} revisions loaded".format(self.df.shape[0]))
+                stage["rows"] = self.df.shape[0]
+            return
+        if self.stream and file_extension == ".json":
+            if self.state_path or self.time_window:
+                print("--state and --time-window need the whole dataset and cannot be "
+                      "combined with --stream")
+                sys.exit(2)
+            # Data files are read lazily by display_aggregate_stats.
+            return
+        if file_extension not in (".json", ".csv"):
             print("Unrecognizable data file format. Data file must be in .csv or .json format!")
             sys.exit()
+        with self.profiler.stage("load") as stage:
+            if file_extension == ".json":
+                data_loader.load_json(data_file_path, self.range_start, self.range_end,
+                                      mode="concat", dtypes=self._load_dtypes(),
+                                      workers=self.workers, cache=self.cache,
+                                      since=self.since, until=self.until,
+                                      validate=self.validate)
+            else:
+                data_loader.load_csv(data_file_path, self.range_start, self.range_end)
+            self.df = data_loader.get_data() 
+            stage["rows"] = 0 if self.df is None else self.df.shape[0]
+
+    def _load_dtypes(self):
+        '''Loader dtypes of the dataset. The columns to count are always loaded in double
+        precision, so that windows are flagged exactly like on the decoded scores.'''
+        return dict(loader.DEFAULT_DTYPES,
+                    **{column: "float64" for column in self.columns_to_count})
+
+    def input_name(self):
+        '''Name of the analysed input in log file names: the dumps opened from the store,
+        or the index range of the data files.'''
+        if self.store_path:
+            return "dumps_{}".format("+".join(self.dumps))
+        return "start_{}_end_{}".format(self.range_start, self.range_end)
 
     def open_log_file(self):
-        '''Open(and if not present, create) an anomaly log file'''
-        self.window_log_file = open("./log/{}/sliding_window_anomaly_{}_start_{}_end_{}.txt".\
-                       format(self.key, self.anomaly_threshold, self.range_start, self.range_end), "w+") 
+        '''Open(and if not present, create) an anomaly log file, and the sink that writes
+        anomalies to it in the chosen log format. With time windows, their anomalies get a
+        log file of their own, named after the window length in seconds.'''
+        self.window_log_file = open("./log/{}/sliding_window_anomaly_{}_{}.{}".\
+                       format(self.key, self.anomaly_threshold, self.input_name(),
+                              anomaly_sink.FORMAT_EXTENSIONS[self.log_format]), "w+") 
+        self.anomaly_sink = anomaly_sink.AnomalySink(self.window_log_file, self.log_format)
+        if self.time_window:
+            self.time_window_sink = anomaly_sink.AnomalySink(open(
+                "./log/{}/time_window_anomaly_{}_{}s_{}.{}".format(
+                    self.key, self.anomaly_threshold, self.time_window, self.input_name(),
+                    anomaly_sink.FORMAT_EXTENSIONS[self.log_format]), "w+"),
+                self.log_format)
 
-    def display_aggregate_stats(self):
+    @_profiled("display_aggregate_stats")
+    def display_aggregate_stats(self, key_non_zero_only=True):
         '''Show aggregate statistics of the dataset. Metrics include mean, median 
-        and standard deviation.'''
-        print("Now displaying aggregate statistics from {} to {}".format(self.range_start, self.range_end))
+        and standard deviation. key_non_zero_only is passed on in streaming mode.'''
+        if self.stream:
+            self.display_aggregate_stats_streaming(key_non_zero_only)
+            return
+        if self.store_path:
+            print("Now displaying aggregate statistics of dumps {}".format(", ".join(self.dumps)))
+        else:
+            print("Now displaying aggregate statistics from {} to {}".format(self.range_start, self.range_end))
+        if self.df.shape[0] == 0:
+            # E.g. a --since/--until range that holds no revision.
+            print("No revisions loaded, no aggregate statistics to display")
+            return
+        stats = self.aggregate_stats().set_index("column")
         fig, axes = plt.subplots(1, 2)
         fig.set_size_inches(18.5, 10.5)
         i = 0
         for column in self.columns_to_count:
-            print("The mean of {} is {:.2f}".format(column, self.df[column].mean()))
-            print("The median of {} is {:.2f}".format(column, self.df[column].median()))
-            print("The std of {} is {:.2f}".format(column, self.df[column].std()))
-            zero_count = self.df[self.df[column] == 0].shape[0]
+            print("The mean of {} is {:.2f}".format(column, stats.at[column, "mean"]))
+            print("The median of {} is {:.2f}".format(column, stats.at[column, "median"]))
+            print("The std of {} is {:.2f}".format(column, stats.at[column, "std"]))
+            zero_count = int(stats.at[column, "zero_count"])
             row_count = self.df.shape[0]
             print("The count of zeros of {} is {}".format(column, zero_count))
             print("The percentage of zeros of {} is {:.2f}%".format(column, zero_count / row_count))
@@ -128,88 +445,374 @@ class Engine:
 
         plt.savefig("./graphs/aggregate/Distribution_Agg.png")
 
+    @_profiled("aggregate_stats")
+    def aggregate_stats(self, by_key=False, non_zero_only=False):
+        '''Count, zero count, mean, median and std of every column to count, over the whole
+        dataset or per key, computed for all columns by a single groupby over the value
+        arrays; no filtered copy of the data frame is made. With non_zero_only, only the
+        edits with non-zero ores scores are counted, and keys without any are left out.
+        Returns a tidy DataFrame with one row per column, or per key and column in order
+        of first appearance of the keys, and columns key (None over the whole dataset),
+        column, non_zero_count (edits of the key with non-zero ores scores), count,
+        zero_count, mean, median and std. Statistics are computed in double precision.'''
+        row_count = self.df.shape[0]
+        non_zero = self.df["ores_damaging"].to_numpy() != 0
+        if by_key:
+            codes, keys = pd.factorize(self.df[self.key_column_name])
+            keys = pd.Index(keys, dtype=object)
+        else:
+            codes, keys = np.zeros(row_count, dtype=np.intp), pd.Index([None], dtype=object)
+        # Rows with a missing key belong to no group.
+        rows = (codes >= 0) & non_zero if non_zero_only else codes >= 0
+        codes = codes[rows]
+        values = pd.DataFrame({column: self.df[column].to_numpy(dtype=np.float64)[rows]
+                               for column in self.columns_to_count})
+        if by_key:
+            stats = values.groupby(codes, sort=True).agg(["count", "mean", "median", "std"])
+            zero_counts = (values == 0).groupby(codes, sort=True).sum()
+            group_codes = stats.index.to_numpy()
+        else:
+            # A single group; aggregating the columns directly skips the grouping.
+            stats = values.agg(["count", "mean", "median", "std"]).unstack().to_frame().T
+            zero_counts = (values == 0).sum().to_frame().T
+            group_codes = np.zeros(1, dtype=np.intp)
+        non_zero_counts = np.bincount(codes, weights=non_zero[rows],
+                                      minlength=len(keys)).astype(np.int64)
+
+        column_count = len(self.columns_to_count)
+        tidy = {"key": np.repeat(keys.to_numpy()[group_codes], column_count),
+                "column": np.tile(np.array(self.columns_to_count, dtype=object),
+                                  group_codes.shape[0]),
+                "non_zero_count": np.repeat(non_zero_counts[group_codes], column_count),
+                "zero_count": zero_counts[self.columns_to_count].to_numpy().ravel()}
+        for metric in ("count", "mean", "median", "std"):
+            tidy[metric] = stats[[(column, metric) for column in
+                                  self.columns_to_count]].to_numpy(dtype=np.float64).ravel()
+        tidy["count"] = tidy["count"].astype(np.int64)
+        return pd.DataFrame(tidy, columns=["key", "column", "non_zero_count", "count",
+                                           "zero_count", "mean", "median", "std"])
+
+    def display_aggregate_stats_streaming(self, key_non_zero_only=True):
+        '''Streaming counterpart of display_aggregate_stats. Reads the data files chunk
+        by chunk and keeps running statistics: mean, std and zero-count are exact, the
+        median and the histograms come from mergeable histogram sketches. Per-key
+        statistics are kept in self.key_stats, over the edits with non-zero ores scores
+        or, if not key_non_zero_only, over all edits, like aggregate_stats(by_key=True,
+        non_zero_only=key_non_zero_only); self.key_non_zero_count counts the edits with
+        non-zero scores of every key. Keys are filled in only if fill_in_missing_key was
+        called, as in memory.'''
+        print("Now displaying aggregate statistics from {} to {}".format(self.range_start, self.range_end))
+        data_loader = loader.Loader()
+        aggregate_stats = dict()
+        for column in self.columns_to_count:
+            aggregate_stats[column] = streaming.KeyedStreamingStats()
+            self.key_stats[column] = streaming.KeyedStreamingStats()
+        self.key_non_zero_count = pd.Series(dtype=np.int64)
+
+        for chunk in data_loader.iter_json_chunks(self.data_file_path, self.range_start,
+                                                  self.range_end, self.chunk_size,
+                                                  dtypes=self._load_dtypes(),
+                                                  since=self.since, until=self.until,
+                                                  validate=self.validate):
+            if self.key == "author" and self.fill_missing_key:
+                chunk = self._fill_in_missing_author(chunk)
+            non_zero = chunk["ores_damaging"].to_numpy() != 0
+            counted = non_zero if key_non_zero_only else slice(None)
+            no_key = np.zeros(chunk.shape[0], dtype=np.int8)
+            if self.key_column_name:
+                keys = chunk[self.key_column_name].to_numpy()
+                self.key_non_zero_count = self.key_non_zero_count.add(
+                    pd.Series(keys[non_zero]).value_counts(), fill_value=0).astype(np.int64)
+            for column in self.columns_to_count:
+                values = chunk[column].to_numpy()
+                aggregate_stats[column].update(no_key, values)
+                if self.key_column_name:
+                    self.key_stats[column].update(keys[counted], values[counted])
+
+        if not aggregate_stats[self.columns_to_count[0]].keys:
+            print("No revisions loaded, no aggregate statistics to display")
+            return
+        fig, axes = plt.subplots(1, 2)
+        fig.set_size_inches(18.5, 10.5)
+        i = 0
+        for column in self.columns_to_count:
+            stats = aggregate_stats[column]
+            row_count = int(stats.count[0]) if stats.keys else 0
+            zero_count = int(stats.zero_count[0]) if stats.keys else 0
+            print("The mean of {} is {:.2f}".format(column, stats.mean[0]))
+            print("The median of {} is {:.2f}".format(column, stats.median()[0]))
+            print("The std of {} is {:.2f}".format(column, stats.std()[0]))
+            print("The count of zeros of {} is {}".format(column, zero_count))
+            print("The percentage of zeros of {} is {:.2f}%".format(column, zero_count / row_count))
+            axes[i].stairs(stats.histogram[0], stats.bin_edges(), fill=True)
+            axes[i].set_title("Distribution of {}".format(column))
+            i += 1
+
+        plt.savefig("./graphs/aggregate/Distribution_Agg.png")
+
     def set_key(self, key_string, key_column_name):
         '''Specify the key to split the dataset on. Only handles single key.'''
         self.key = key_string
         self.key_column_name = key_column_name
+        self.group_index = None
+        self.temporal_index = None
 
+    @_profiled("fill_in_missing_key")
     def fill_in_missing_key(self):
         '''For some key columns, there exists empty values. We must replace
         them with values from other columns.'''
+        self.fill_missing_key = True
         if self.key == "author":
-            self.df.author[self.df.author == ""] = self.df.ip 
+            self.df = self._fill_in_missing_author(self.df)
+            self.group_index = None
+            self.temporal_index = None
+
+    @staticmethod
+    def _fill_in_missing_author(frame):
+        '''Replace empty authors of a frame with the editor ip. Categorical authors are
+        filled on their codes, without decoding any string.'''
+        if not isinstance(frame["author"].dtype, pd.CategoricalDtype):
+            author = frame["author"].astype(str)
+            frame["author"] = author.where(author != "", frame["ip"].astype(str))
+            return frame
+        row_count = frame.shape[0]
+        combined = loader.combine_categoricals([frame["author"], frame["ip"]])
+        author_codes, ip_codes = combined.codes[:row_count], combined.codes[row_count:]
+        empty_code = combined.categories.get_indexer([""])[0]
+        if empty_code >= 0:
+            author_codes = np.where(author_codes == empty_code, ip_codes, author_codes)
+        frame["author"] = pd.Categorical.from_codes(
+            author_codes, categories=combined.categories).remove_unused_categories()
+        return frame
+
+    @_profiled("build_group_index")
+    def build_group_index(self):
+        '''Partition the dataset by key column in a single pass. Rows are stably sorted by
+        the code of their key, so each group is a contiguous slice of the sorted frame
+        and keeps its original row order. Groups are numbered in order of first
+        appearance, like unique(). Rows with a missing key belong to no group.
+        Scores may be stored in single precision; the partitioned copy holds them in
+        double precision so that every task computes its statistics in double precision.'''
+        codes, group_keys = pd.factorize(self.df[self.key_column_name])
+        order = np.argsort(codes, kind="stable")
+        sizes = np.bincount(codes[codes >= 0], minlength=len(group_keys))
+        offsets = np.zeros(len(group_keys) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        # Missing keys have code -1 and are sorted in front of every group.
+        offsets += np.count_nonzero(codes < 0)
+        sorted_df = self.df.take(order).astype(
+            {column: "float64" for column in self.columns_to_count})
+        self.group_index = (sorted_df, group_keys, offsets)
+        self.group_count = len(group_keys)
+        return self.group_index
+
+    def _shard_groups(self, processes):
+        '''Split the group indices into shards of roughly equal row counts, by handing
+        the largest remaining group to the least loaded shard.'''
+        _, _, offsets = self.group_index
+        sizes = np.diff(offsets)
+        shards = [[] for _ in range(processes)]
+        loads = np.zeros(processes, dtype=np.int64)
+        for index in np.argsort(-sizes, kind="stable"):
+            lightest = int(np.argmin(loads))
+            shards[lightest].append(int(index))
+            loads[lightest] += sizes[index]
+        return [shard for shard in shards if shard]
+
+    def _iterate_per_key_parallel(self, operations, processes):
+        '''Run the operations on all groups with a pool of forked worker processes.
+        Log lines and console output are written back in group order, so the result is
+        identical to a serial run.'''
+        _worker_state["engine"] = self
+        _worker_state["operations"] = operations
+        try:
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                shard_outputs = pool.map(_run_group_shard, self._shard_groups(processes))
+        finally:
+            _worker_state.clear()
+
+        group_outputs = sorted((output for shard_output in shard_outputs
+                                for output in shard_output), key=lambda output: output[0])
+        results = []
+        for index, records, log_text, console_text, group_results, seconds in group_outputs:
+            self._record_group_times(operations, index, seconds)
+            if records:
+                self.anomaly_sink.extend(records)
+            if log_text:
+                if self.anomaly_sink is not None:
+                    self.anomaly_sink.flush()
+                self.window_log_file.write(log_text)
+            if console_text:
+                sys.stdout.write(console_text)
+            results.append(group_results)
+        return results
 
-    def iterate_per_key(self, *argv):
+    def iterate_per_key(self, *argv, processes=1):
         '''Perform required operation on each group, grouped by key column.
-           The operation must be a instance method of the Engine class.'''
-        self.group_count = len(self.df[self.key_column_name].unique())
-        index = 0
-        for group in self.df[self.key_column_name].unique():
-            for operation in argv:
-                operation(self.df.loc[self.df[self.key_column_name] == group], group, index)
-            index += 1
+           The operation must be a instance method of the Engine class.
+           Each group is handed over as a slice of the partitioned dataset.
+           With processes > 1, groups are split into shards of similar size and run by
+           forked worker processes. Operations then run on a copy of the engine, so they
+           must report through the log file, the console or their return value rather
+           than by changing shared state.
+           Returns, for each group in order, the list of values returned by the operations.'''
+        if self.group_index is None:
+            self.build_group_index()
+        self._task_seconds = [0.0] * len(argv)
+        with self.profiler.stage("iterate_per_key", self.df.shape[0]):
+            if processes > 1 and self.group_count > 1 and \
+               "fork" in multiprocessing.get_all_start_methods():
+                results = self._iterate_per_key_parallel(argv,
+                                                         min(processes, self.group_count))
+            else:
+                sorted_df, group_keys, offsets = self.group_index
+                results = []
+                for index, group in enumerate(group_keys):
+                    group_frame = sorted_df.iloc[offsets[index]:offsets[index + 1]]
+                    group_results, seconds = _run_operations(argv, group_frame, group, index)
+                    self._record_group_times(argv, index, seconds)
+                    results.append(group_results)
+        # Tasks alternate from group to group, so only the iterate_per_key stage, around
+        # all of them, measures the memory change; task stages report time only.
+        for operation, seconds in zip(argv, self._task_seconds):
+            self.profiler.add_stage("task " + self._task_name(operation), seconds,
+                                    self.df.shape[0])
+        return results
+
+    @staticmethod
+    def _task_name(operation):
+        return getattr(operation, "__name__", repr(operation))
+
+    def _record_group_times(self, operations, index, seconds):
+        '''Add the wall times of the operations on one group to the profiler.'''
+        _, group_keys, offsets = self.group_index
+        rows = int(offsets[index + 1] - offsets[index])
+        for task_index, operation in enumerate(operations):
+            self._task_seconds[task_index] += seconds[task_index]
+            self.profiler.record_group(self._task_name(operation), index, group_keys[index],
+                                       seconds[task_index], rows)
+
+    def _plots_group(self, index):
+        '''Whether the group at index gets figures under plot_limit and plot_every. Groups
+        are sampled by index, so the choice does not depend on which process plots them.'''
+        if index % self.plot_every != 0:
+            return False
+        return self.plot_limit is None or index // self.plot_every < self.plot_limit
+
+    def _get_plotter(self, kind):
+        '''Return the reusable GroupPlotter of a plot kind, creating it on first use.'''
+        if kind not in self.plotters:
+            self.plotters[kind] = plotting.GroupPlotter(
+                kind, self.columns_to_count, "./graphs/{}".format(self.key),
+                tiles=self.tile_grid if self.plot_mode == "tiles" else None)
+        return self.plotters[kind]
+
+    def finish_plots(self):
+        '''Save partially filled sheets and release the reused figures.'''
+        for plotter in self.plotters.values():
+            plotter.finish()
+        self.plotters = dict()
+
+    def group_stats(self, group, group_key, index):
+        '''Statistics of a group as a dict: the edit count and number of edits with
+        non-zero ores scores, and per column the mean, median, std and zero count over
+        all edits, and the mean and median over the edits with non-zero ores scores.'''
+        non_zero = group.loc[group["ores_damaging"] != 0]
+        stats = {"key": group_key, "edit_count": int(group.shape[0]),
+                 "non_zero_count": int(non_zero.shape[0])}
+        for column in self.columns_to_count:
+            stats[column] = {"mean": group[column].mean(),
+                             "median": group[column].median(),
+                             "std": group[column].std(),
+                             "zero_count": int((group[column] == 0).sum()),
+                             "non_zero_mean": non_zero[column].mean(),
+                             "non_zero_median": non_zero[column].median()}
+        return stats
 
     def display_per_group_stats(self, group, group_key, index):
         '''Displays statistics of each group. Metrics include mean, median
            and standard deviation.'''
+        stats = self.group_stats(group, group_key, index)
+        for column in self.columns_to_count:
+            print("Now displaying statistics for {} {}".format(self.key, group_key))
+            print("The mean of {} is {:.2f}".format(column, stats[column]["mean"]))
+            print("The median of {} is {:.2f}".format(column, stats[column]["median"]))
+            print("The std of {} is {:.2f}".format(column, stats[column]["std"]))
+        if not self._plots_group(index):
+            return
+
+        titles = ["Distribution of {} for {} {}".format(column, self.key, group_key)
+                  for column in self.columns_to_count]
+        # Path cannot contain /, but some wikipedia article names contain the "/"
+        # character, which we must remove
+        file_name = "Distribution_{}".format(group_key.replace("/", ""))
+        if self.plot_mode != "figure":
+            self._get_plotter("distribution").plot(
+                group_key, file_name, titles,
+                [group[column].to_numpy() for column in self.columns_to_count])
+            return
+
         fig, axes = plt.subplots(1, 2)
         fig.set_size_inches(18.5, 10.5)
         i = 0
-
         for column in self.columns_to_count:
-            print("Now displaying statistics for {} {}".format(self.key, group_key))
-            print("The mean of {} is {:.2f}".format(column, group[column].mean()))
-            print("The median of {} is {:.2f}".format(column, group[column].median()))
-            print("The std of {} is {:.2f}".format(column, group[column].std()))
             axes[i].hist(group[column], bins=20)
-            axes[i].set_title("Distribution of {} for {} {}".format(column, self.key, group_key))
+            axes[i].set_title(titles[i])
             i += 1
-        # Path cannot contain /, but some wikipedia article names contain the "/"
-        # character, which we must remove
-        plt.savefig("./graphs/{}/Distribution_{}.png".format(self.key, group_key.replace("/", "")))
+        plt.savefig("./graphs/{}/{}.png".format(self.key, file_name))
         plt.close()
 
     def plot_evolution_across_time(self, group, group_key, index):
         '''Plots the change of ores scores of a given group through time.'''
-        non_zero_articles = group.loc[group["ores_damaging"] != 0].copy()
+        non_zero_articles = self._time_series(group, group_key, index)
         non_zero_count = non_zero_articles.shape[0]
-        non_zero_articles.sort_values(by="timestamp", ascending=True, inplace=True)
-        if non_zero_count <= 1:
+        if non_zero_count <= 1 or not self._plots_group(index):
+            return
+
+        times = non_zero_articles["timestamp"]
+        if pd.api.types.is_integer_dtype(times):
+            times = pd.to_datetime(times, unit="s")
+        titles = ["Change of {} for article {}".format(column, group_key)
+                  for column in self.columns_to_count]
+        file_name = "Evolution_{}".format(group_key.replace("/", ""))
+        if self.plot_mode != "figure":
+            self._get_plotter("evolution").plot(
+                group_key, file_name, titles,
+                [non_zero_articles[column].to_numpy() for column in self.columns_to_count],
+                times.to_numpy())
             return
 
         fig, axes = plt.subplots(1, 2)
         fig.set_size_inches(18.5, 10.5)
         i = 0
         for column in self.columns_to_count:
-            axes[i].plot(non_zero_articles["timestamp"], non_zero_articles[column])
-            axes[i].set_title("Change of {} for article {}".format(column, group_key))
+            axes[i].plot(times, non_zero_articles[column])
+            axes[i].set_title(titles[i])
             i += 1
-        plt.savefig("./graphs/{}/Evolution_{}.png".format(self.key, group_key.replace("/", "")))
+        plt.savefig("./graphs/{}/{}.png".format(self.key, file_name))
         plt.close()
 
+    @staticmethod
+    def format_timestamp(timestamp):
+        '''Render a timestamp for log lines. Timestamps are kept as epoch seconds in
+        memory and shown as UTC date-times, matching the original log format.'''
+        return anomaly_sink.format_timestamp(timestamp)
+
     def sliding_window_analysis(self, group, group_key, index):
         '''Detect anomalies using sliding window analysis. Anomalies are
         defined to be values that deviate significantly from a period's average'''
 
         # Get the edits with non-zero ores score for time-series analysis
-        non_zero_articles = group.loc[group["ores_damaging"] != 0].copy()
+        non_zero_articles = self._time_series(group, group_key, index)
         non_zero_count = non_zero_articles.shape[0]
-        # If multiplier is -1, then a higher value indicates an edit is "good" (less likely
-        # to be vandalism). If multiplier is 1, then a higher value indicates an edit
-        # is "bad" (more likely to be vandalism).
-        # This is because for columns where higher value is "good", we only watch for
-        # abnormally low values (we care less about the abnormally high values), 
-        # and for columns where higher value is "bad", we only watch for the 
-        # abnormally high values. 
-        column_diff_multiplier = {"ores_damaging": 1, "ores_goodfaith": -1}
+        column_diff_multiplier = self.column_diff_multiplier
 
         # Constants for sliding window analysis
-        window_size = 10
+        window_size = self.window_size
         if non_zero_count <= 1:
             return
-        if non_zero_count < 10:
+        if non_zero_count < self.window_size:
             window_size = 1
-        non_zero_articles.sort_values(by="timestamp", ascending=True, inplace=True)
 
         # Sliding window analysis to identify periods of extreme values
         window_index = 0
@@ -217,7 +820,13 @@ class Engine:
         baselines_median = dict()
         for column in self.columns_to_count:
             baselines_mean[column] = non_zero_articles[column].mean()
-            baselines_median[column] = non_zero_articles[column].median()
+            if self.median_mode == "sketch":
+                # Sketched like in detect_window_anomalies (same seed, same values in the
+                # same order), so both paths get the same estimate and flag the same windows.
+                baselines_median[column] = sketch.KLLSketch(self.sketch_k).update(
+                    non_zero_articles[column].to_numpy()).median()
+            else:
+                baselines_median[column] = non_zero_articles[column].median()
 
         while window_index + window_size <= non_zero_count: 
             window_frame = non_zero_articles[window_index: window_index + window_size]
@@ -231,21 +840,264 @@ class Engine:
                 mean_diff_percent = mean_diff / baselines_mean[column] * 100.0
                 median_diff_percent = median_diff / baselines_median[column] * 100.0
                 if mean_diff_percent > self.anomaly_threshold:
-                    self.window_log_file.write(("Anomaly of mean of {} detected for {} during " 
-                        "period from {} to {}, with a {:.2f} percent difference "
-                        "from baseline.\n").format(\
-                        column, group_key, starting_time, ending_time, mean_diff_percent))
+                    self.anomaly_sink.add(group_key, column, "mean", starting_time,
+                                          ending_time, mean_diff_percent)
                 if median_diff_percent > self.anomaly_threshold:
-                    self.window_log_file.write(("Anomaly of median of {} detected for {} "
-                        "during period from {} to {}, with a {:.2f} percent difference "
-                        "from baseline.\n").format(\
-                        column, group_key, starting_time, ending_time, median_diff_percent))
+                    self.anomaly_sink.add(group_key, column, "median", starting_time,
+                                          ending_time, median_diff_percent)
 
             window_index = window_index + 1
 
+    @_profiled("build_temporal_index")
+    def build_temporal_index(self):
+        '''Index the edits with non-zero ores scores and a key, the input of every
+        time-series task, by (key, timestamp) in a single sort. Key codes follow the
+        group numbering of build_group_index. Besides its row in self.df, the index
+        keeps the position of each edit in its group's slice of the group index, so
+        per-group tasks can take their time series from the group they are handed.'''
+        key_codes, group_keys = pd.factorize(self.df[self.key_column_name])
+        rows = np.flatnonzero((self.df["ores_damaging"] != 0).to_numpy() & (key_codes >= 0))
+        self.temporal_index = temporal_index.TemporalIndex(
+            key_codes[rows], self.df["timestamp"].to_numpy()[rows], group_keys, rows)
+        # Rows keep their order within a group, so the position of a row in its group is
+        # the number of earlier rows with the same key.
+        group_order = np.argsort(key_codes, kind="stable")
+        first_row = np.zeros(len(group_keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(key_codes[key_codes >= 0], minlength=len(group_keys)),
+                  out=first_row[1:])
+        first_row += np.count_nonzero(key_codes < 0)
+        rank = np.empty(key_codes.shape[0], dtype=np.int64)
+        rank[group_order] = np.arange(key_codes.shape[0])
+        index = self.temporal_index
+        self.group_positions = rank[index.rows] - first_row[index.codes]
+        self.group_sizes = np.diff(first_row)
+        return self.temporal_index
+
+    def _time_series(self, group, group_key, index):
+        '''The edits of a group with non-zero ores scores, sorted by timestamp, taken
+        from the temporal index instead of filtering and sorting the group. The index is
+        only used when its group numbering matches, i.e. the group has slot index's key
+        and row count; other groups are filtered and sorted directly.'''
+        if self.temporal_index is None:
+            self.build_temporal_index()
+        group_keys = self.temporal_index.group_keys
+        if index < len(group_keys) and group_keys[index] == group_key \
+                and group.shape[0] == self.group_sizes[index]:
+            span = slice(self.temporal_index.offsets[index],
+                         self.temporal_index.offsets[index + 1])
+            return group.take(self.group_positions[span])
+        non_zero_articles = group.loc[group["ores_damaging"] != 0]
+        return non_zero_articles.sort_values(by="timestamp", kind="stable")
+
+    def _window_columns(self):
+        '''Timestamps and values to count of the indexed edits, in index order. Values
+        are read in double precision.'''
+        if self.temporal_index is None:
+            self.build_temporal_index()
+        rows = self.temporal_index.rows
+        return {column: self.df[column].to_numpy(dtype=np.float64)[rows]
+                for column in self.columns_to_count}
+
+    def _baselines(self, codes, column_values, group_keys, column):
+        '''Mean and median of the values of every group, over all of its edits.'''
+        grouped = pd.Series(column_values).groupby(codes)
+        baselines = {"mean": grouped.mean().reindex(range(len(group_keys))).to_numpy()}
+        if self.median_mode == "sketch":
+            keyed_sketch = sketch.KeyedQuantileSketch(self.sketch_k)
+            keys = np.asarray(group_keys, dtype=object)
+            keyed_sketch.update(keys[codes], column_values)
+            baselines["median"] = keyed_sketch.median(keys)
+        else:
+            baselines["median"] = grouped.median().reindex(range(len(group_keys))).to_numpy()
+        return baselines
+
+    def _flag_windows(self, codes, timestamps, values, group_keys, window_starts,
+                      window_ends, window_values):
+        '''Flag the windows whose metrics deviate from the baselines of their group.
+        Edits are sorted by (key code, timestamp); values maps each column to count to its
+        values in the same order. The window from window_starts[w] to window_ends[w]
+        (inclusive positions) has mean and median window_values(column_values, metric).
+        Returns the anomalies in log order: group, window, column, then metric.'''
+        window_groups = codes[window_starts]
+        found = {"group": [], "start": [], "column": [], "metric": [], "percent_diff": []}
+        for column_index, column in enumerate(self.columns_to_count):
+            column_values = values[column]
+            baselines = self._baselines(codes, column_values, group_keys, column)
+            for metric_index, metric in enumerate(("mean", "median")):
+                baseline = baselines[metric][window_groups]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    diff_percent = self.column_diff_multiplier[column] * \
+                                   (window_values(column_values, metric) - baseline) / \
+                                   baseline * 100.0
+                self._recompute_near_threshold(diff_percent, codes, column, column_values,
+                                               metric, window_groups, window_starts,
+                                               window_ends, baseline)
+                flagged = np.flatnonzero(diff_percent > self.anomaly_threshold)
+                found["group"].append(window_groups[flagged])
+                found["start"].append(flagged)
+                found["column"].append(np.full(flagged.shape[0], column_index))
+                found["metric"].append(np.full(flagged.shape[0], metric_index))
+                found["percent_diff"].append(diff_percent[flagged])
+
+        found = {name: np.concatenate(parts) for name, parts in found.items()}
+        rank = np.lexsort((found["metric"], found["column"], found["start"], found["group"]))
+        window_index = found["start"][rank]
+        # Keys stay codes into group_keys; the sink decodes them as lines are written.
+        return pd.DataFrame({
+            "key": pd.Categorical.from_codes(found["group"][rank],
+                                             categories=pd.Index(group_keys, dtype=object)),
+            "column": np.asarray(self.columns_to_count, dtype=object)[found["column"][rank]],
+            "metric": np.array(["mean", "median"], dtype=object)[found["metric"][rank]],
+            "start": timestamps[window_starts[window_index]],
+            "end": timestamps[window_ends[window_index]],
+            "percent_diff": found["percent_diff"][rank]})
+
+    def _recompute_near_threshold(self, diff_percent, codes, column, column_values, metric,
+                                  window_groups, window_starts, window_ends, baseline):
+        '''Recompute, in place, the percent differences within rounding error of the
+        threshold the way sliding_window_analysis computes them. Baselines and windows are
+        summed in another order here, so a window at exactly the threshold could
+        otherwise be flagged differently. Baseline medians from sketches are kept.'''
+        near = np.flatnonzero(np.abs(diff_percent - self.anomaly_threshold) < 1e-6)
+        if not near.shape[0]:
+            return
+        group_starts = np.searchsorted(codes, window_groups[near], side="left")
+        group_ends = np.searchsorted(codes, window_groups[near], side="right")
+        for window, group_start, group_end in zip(near, group_starts, group_ends):
+            window_frame = pd.Series(column_values[window_starts[window]:
+                                                   window_ends[window] + 1])
+            if metric == "mean":
+                group_baseline = pd.Series(column_values[group_start:group_end]).mean()
+                window_value = window_frame.mean()
+            else:
+                group_baseline = baseline[window] if self.median_mode == "sketch" else \
+                                 pd.Series(column_values[group_start:group_end]).median()
+                window_value = window_frame.median()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                diff_percent[window] = self.column_diff_multiplier[column] * \
+                                       np.float64(window_value - group_baseline) / \
+                                       group_baseline * 100.0
+
+    def _scan_windows(self, codes, timestamps, values, group_keys, first_window=None):
+        '''Flag the anomalous windows of window_size consecutive edits, over edits
+        sorted by (key code, timestamp). If first_window is given, windows of group g starting
+        before position first_window[g] of the group are not scanned.
+        Returns the anomalies in log order: group, window, column, then metric.'''
+        # Locate every window by its first edit. A window starts at each position that
+        # leaves room for a full window before the end of its group.
+        sizes = np.bincount(codes, minlength=len(group_keys))
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        group_windows = np.where(sizes >= self.window_size, self.window_size, 1)
+        position = np.arange(codes.shape[0]) - offsets[codes]
+        row_windows = group_windows[codes]
+        valid = (sizes[codes] > 1) & (position + row_windows <= sizes[codes])
+        if first_window is not None:
+            valid &= position >= first_window[codes]
+        window_starts = np.flatnonzero(valid)
+        window_ends = window_starts + row_windows[window_starts] - 1
+        wide = row_windows[window_starts] > 1
+
+        def window_values(column_values, metric):
+            result = column_values[window_starts].copy()
+            if wide.any():
+                frames = sliding_window_view(column_values,
+                                             self.window_size)[window_starts[wide]]
+                result[wide] = frames.mean(axis=1) if metric == "mean" else \
+                               np.median(frames, axis=1)
+            return result
+
+        return self._flag_windows(codes, timestamps, values, group_keys, window_starts,
+                                  window_ends, window_values)
+
+    @_profiled("detect_window_anomalies")
+    def detect_window_anomalies(self):
+        '''Vectorized sliding window analysis of every group at once. The non-zero edits
+        are taken from the temporal index, sorted by (key, timestamp); window means and
+        medians are then computed for all windows of all groups together, without
+        windows crossing group bounds.
+        The same windows as sliding_window_analysis are flagged, including the fallback
+        to single-edit windows for groups with fewer than window_size edits, and the log
+        lines are written in the same order. Returns the anomalies as a DataFrame with
+        columns key, column, metric, start, end and percent_diff.'''
+        values = self._window_columns()
+        index = self.temporal_index
+        anomalies = self._scan_windows(index.codes, index.timestamps, values, index.group_keys)
+        self.anomaly_sink.add_frame(anomalies)
+        return anomalies
+
+    @_profiled("detect_time_window_anomalies")
+    def detect_time_window_anomalies(self):
+        '''Sliding window analysis with windows of a fixed length of time instead of a
+        fixed number of edits. For every non-zero edit, the window holds the edits of the
+        same key within the preceding self.time_window seconds, e.g. "the last 24h",
+        and is compared with the baselines of the key like the fixed windows are. Window
+        bounds come from one binary search over the temporal index, window means from
+        prefix sums. Keys with a single non-zero edit are skipped. Anomalies are written to
+        time_window_sink, not to the log of the fixed windows.
+        Returns the anomalies like detect_window_anomalies.'''
+        values = self._window_columns()
+        index = self.temporal_index
+        sizes = np.diff(index.offsets)
+        window_ends = np.flatnonzero(sizes[index.codes] > 1)
+        window_starts = index.trailing_window_starts(self.time_window)[window_ends]
+        lengths = window_ends - window_starts + 1
+
+        def window_values(column_values, metric):
+            if metric == "mean":
+                prefix = np.concatenate([[0.0], np.cumsum(column_values)])
+                return (prefix[window_ends + 1] - prefix[window_starts]) / lengths
+            result = column_values[window_ends].copy()
+            for window in np.flatnonzero(lengths > 1):
+                result[window] = np.median(
+                    column_values[window_starts[window]:window_ends[window] + 1])
+            return result
+
+        anomalies = self._flag_windows(index.codes, index.timestamps, values,
+                                       index.group_keys, window_starts, window_ends,
+                                       window_values)
+        self.time_window_sink.add_frame(anomalies)
+        return anomalies
+
+    @_profiled("update_window_anomalies")
+    def update_window_anomalies(self):
+        '''Incremental sliding window analysis. The loaded data is treated as new edits
+        on top of the per-key state saved at self.state_path by earlier runs. Only keys
+        with new edits are analysed: their baselines are recomputed over all their edits,
+        and only the windows from the first one holding a new edit onwards are scanned.
+        Later windows hold old edits only, and are scanned again, where new edits predate
+        stored ones. Revisions already in the state are ignored. The state is saved back
+        afterwards.
+        Returns the anomalies like detect_window_anomalies.'''
+        store = state_store.WindowStateStore.load(self.state_path, self.key_column_name,
+                                                  self.columns_to_count, self.window_size)
+        values = self._window_columns()
+        index = self.temporal_index
+        codes, timestamps, values, keys, first_window = store.add_edits(
+            np.asarray(index.group_keys, dtype=object)[index.codes], index.timestamps,
+            self.df["revision_id"].to_numpy(dtype=np.int64)[index.rows], values)
+        anomalies = self._scan_windows(codes, timestamps, values, keys, first_window)
+        self.anomaly_sink.add_frame(anomalies)
+        store.save(self.state_path)
+        return anomalies
+
     def cleanup(self):
-        '''Perform necessary cleanup work, like closing files.'''
-        self.window_log_file.close()
+        '''Perform necessary cleanup work, like closing files, and report the timings of
+        the run.'''
+        self.finish_plots()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+        print(self.profiler.report())
+        if self.profile_json_path:
+            self.profiler.dump_json(self.profile_json_path)
+        if self.anomaly_sink is not None:
+            self.anomaly_sink.close()
+        elif self.window_log_file:
+            self.window_log_file.close()
+        if self.time_window_sink is not None:
+            self.time_window_sink.close()
 
 
 
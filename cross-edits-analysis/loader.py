@@ -20,7 +20,327 @@
     operations and further analysis will then be performed using the data object.
 
 '''
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import io
+import itertools
+import json
+import math
+import os
+import re
+import shutil
+import numpy as np
 import pandas as pd
+try:
+    import orjson
+except ImportError:
+    # Without orjson, records are decoded by pandas' own json reader.
+    orjson = None
+
+# Declared schema of a revision record: field -> (decoded dtype, nullable). Fields are
+# decoded straight to these dtypes; "str" fields are kept as strings until the target
+# dtypes of DEFAULT_DTYPES are applied.
+RECORD_SCHEMA = {"site_id": ("str", False), "page_id": ("int64", False),
+                 "title": ("str", False), "url": ("str", True),
+                 "revision_id": ("int64", False), "timestamp": ("int64", False),
+                 "author": ("str", False), "ip": ("str", False), "is_bot": ("bool", False),
+                 "ores_damaging": ("float64", False), "ores_goodfaith": ("float64", False)}
+
+# Fields holding ORES probabilities, which validation checks to lie in [0, 1].
+SCORE_FIELDS = ["ores_damaging", "ores_goodfaith"]
+
+# Columns kept by the concatenating loader unless the caller asks otherwise. The
+# "url" column is never used by any analysis and is dropped by default.
+DEFAULT_COLUMNS = ["site_id", "page_id", "title", "revision_id", "timestamp", "author",
+                   "ip", "is_bot", "ores_damaging", "ores_goodfaith"]
+
+# Target dtypes of the concatenating loader. Keys are stored as categoricals, i.e. dense
+# integer codes into a dictionary of their distinct strings, timestamps as raw epoch
+# seconds and ORES scores at the full precision they are decoded with.
+DEFAULT_DTYPES = {"site_id": "category", "title": "category", "author": "category",
+                  "ip": "category", "timestamp": "int64", "ores_damaging": "float64",
+                  "ores_goodfaith": "float64"}
+
+# Opt-in dtypes that also store ORES scores in single precision, halving their memory.
+# Rounded scores can change which windows reach the anomaly threshold, so the Engine
+# does not use them.
+COMPACT_DTYPES = dict(DEFAULT_DTYPES, ores_damaging="float32", ores_goodfaith="float32")
+
+def _apply_numeric_schema(frame, columns, dtypes):
+    '''Keep only the requested columns and apply every non-categorical dtype.'''
+    if columns is not None:
+        frame = frame[[column for column in columns if column in frame.columns]]
+    for column, dtype in dtypes.items():
+        if column in frame.columns and dtype != "category":
+            frame[column] = frame[column].astype(dtype)
+    return frame
+
+def _decode_column(values, field):
+    '''Build one column from the decoded values of a field, using its declared dtype.
+    Values that do not fit the dtype, e.g. missing integers, are left for pandas to
+    infer, and are reported by validation.'''
+    dtype = RECORD_SCHEMA.get(field, ("object", True))[0]
+    if dtype in ("str", "object"):
+        return np.array(values, dtype=object)
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return pd.Series(values).to_numpy()
+
+# Negative powers of ten by which pandas' json reader scales decimal fractions.
+_FRACTION_SCALES = np.array([1.0] + [float("1e-{}".format(digits)) for digits in range(1, 16)])
+
+def _pandas_float(number):
+    '''Value of a json number as decoded by pandas' json reader without precise_float:
+    the integer part plus up to 15 fraction digits times a power of ten, then times
+    10 ** exponent.'''
+    number, _, exponent = number.lower().partition(b"e")
+    integer, _, fraction = number.partition(b".")
+    fraction = fraction[:15]
+    value = abs(int(integer)) + float(int(fraction or b"0")) * _FRACTION_SCALES[len(fraction)]
+    if integer.startswith(b"-"):
+        value = -value
+    return value * math.pow(10.0, int(exponent)) if exponent else value
+
+def _decode_floats(text, fields, count):
+    '''Decode the numbers of float fields from the raw json text of count records the
+    way pandas' json reader does. Its results differ from correctly rounded parsing in
+    the last bit for many decimals (0.284 decodes as 0.28400000000000003), which can
+    move a window across the anomaly threshold. The text is scanned once for all fields
+    and each distinct number is converted once. Returns a dict of field -> values, or
+    None unless every record holds a plain number for every field.'''
+    matches = re.findall(b'"(' + b"|".join(re.escape(field.encode("utf-8"))
+                                            for field in fields) +
+                         rb')"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)\s*[,}]', text)
+    if len(matches) != count * len(fields):
+        return None
+    names, numbers = zip(*matches) if matches else ((), ())
+    codes, distinct = pd.factorize(np.array(numbers, dtype=object))
+    values = np.array([_pandas_float(number) for number in distinct], dtype=np.float64)[codes]
+    names = np.array(names, dtype=object)
+    decoded = dict()
+    for field in fields:
+        field_values = values[names == field.encode("utf-8")]
+        if field_values.shape[0] != count:
+            return None
+        decoded[field] = field_values
+    return decoded
+
+# Numbers decoded by both _decode_floats and pandas' json reader to check that they
+# agree: ORES-like scores with 1 to 17 fraction digits, and a few edge cases.
+_ROUNDING_SAMPLES = [b"0", b"1", b"-0.5", b"0.284", b"0.1", b"0.28400000000000003",
+                     b"0.9999999999999999", b"1e-05", b"1.5E+2", b"123.456e-2",
+                     b"0.00123456789012345678"] + \
+                    ["{:.{}f}".format(value, 1 + index % 17).encode("ascii") for index, value
+                     in enumerate(np.random.default_rng(0).random(2000))]
+
+@functools.lru_cache(maxsize=None)
+def pandas_rounding_matches():
+    '''True if _decode_floats decodes sample numbers to exactly the values of the
+    installed pandas' json reader. _pandas_float mirrors how that reader rounds
+    decimals; should a pandas release change it, records are decoded by pandas itself
+    instead. Checked once per process.'''
+    text = b"\n".join(b'{"score": ' + number + b"}" for number in _ROUNDING_SAMPLES)
+    decoded = _decode_floats(text, ["score"], len(_ROUNDING_SAMPLES))
+    expected = pd.read_json(io.BytesIO(text), orient="records", typ="frame", lines=True)
+    return decoded is not None and \
+           np.array_equal(decoded["score"], expected["score"].to_numpy(dtype=np.float64))
+
+def _decode_json_lines(lines, columns):
+    '''Decode json records, one per line, into a frame holding only the given fields
+    (every field of the first record if columns is None). With orjson, all lines are
+    decoded in a single call and only the projected fields are turned into columns;
+    otherwise pandas' json reader parses every field and the projection is applied
+    afterwards. Either way, float fields decode to the same values as with pandas' json
+    reader: the orjson path is only taken if pandas_rounding_matches().'''
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return pd.DataFrame(columns=columns)
+    if orjson is not None and pandas_rounding_matches():
+        records = orjson.loads(b"[" + b",".join(lines) + b"]")
+        # Like pd.read_json, only fields present in the records become columns.
+        fields = [column for column in (columns or records[0]) if column in records[0]]
+        float_fields = [column for column in fields
+                        if RECORD_SCHEMA.get(column, ("object",))[0] == "float64"]
+        data = _decode_floats(b"\n".join(lines), float_fields, len(records)) \
+               if float_fields else dict()
+        if data is not None:
+            for column in fields:
+                if column not in data:
+                    data[column] = _decode_column([record.get(column) for record in records],
+                                                  column)
+            return pd.DataFrame(data, columns=fields)
+    frame = pd.read_json(io.BytesIO(b"\n".join(lines)), orient="records", typ="frame",
+                         lines=True, convert_dates=False)
+    return frame if columns is None else \
+           frame[[column for column in columns if column in frame.columns]]
+
+def validate_records(frame, source=""):
+    '''Check a decoded frame against RECORD_SCHEMA: non-nullable fields must have no
+    missing values, numeric fields must have decoded as numbers and ORES scores must
+    lie in [0, 1]. Raises ValueError naming the source and the offending field.'''
+    for field in frame.columns:
+        if field not in RECORD_SCHEMA:
+            continue
+        dtype, nullable = RECORD_SCHEMA[field]
+        missing = int(frame[field].isna().sum())
+        if missing and not nullable:
+            raise ValueError("{}: field {} has {} missing values".format(source, field,
+                                                                       missing))
+        if dtype != "str" and not pd.api.types.is_numeric_dtype(frame[field]) and \
+           not pd.api.types.is_bool_dtype(frame[field]):
+            raise ValueError("{}: field {} is not of type {}".format(source, field, dtype))
+        if field in SCORE_FIELDS:
+            scores = frame[field].to_numpy(dtype=np.float64)
+            if ((scores < 0) | (scores > 1)).any():
+                raise ValueError("{}: field {} has scores outside [0, 1]".format(source,
+                                                                               field))
+
+def _select_time_range(frame, since, until):
+    '''Keep the rows with since <= timestamp < until. Either bound may be None.'''
+    if since is None and until is None:
+        return frame
+    timestamps = frame["timestamp"].to_numpy()
+    keep = np.ones(timestamps.shape[0], dtype=bool)
+    if since is not None:
+        keep &= timestamps >= since
+    if until is not None:
+        keep &= timestamps < until
+    return frame[keep].reset_index(drop=True)
+
+def _apply_categorical_schema(frame, dtypes):
+    '''Encode the categorical columns of a frame. Categories are local to the frame
+    until frames are combined with combine_categoricals.'''
+    for column, dtype in dtypes.items():
+        if column in frame.columns and dtype == "category":
+            frame[column] = frame[column].astype(dtype)
+    return frame
+
+def combine_categoricals(parts):
+    '''Concatenate categorical Series or Categoricals with different categories into
+    a single Categorical, by remapping their codes to the union of the categories.
+    Values are never decoded to strings, and categories keep their order of first
+    appearance across parts.'''
+    parts = [pd.Categorical(part) if not isinstance(getattr(part, "dtype", None),
+                                                    pd.CategoricalDtype)
+             else part for part in parts]
+    parts = [part.array if isinstance(part, pd.Series) else part for part in parts]
+    categories = pd.Index(np.concatenate([np.asarray(part.categories, dtype=object)
+                                          for part in parts])).unique()
+    codes = []
+    for part in parts:
+        # A trailing -1 maps the missing value code -1 to itself.
+        remap = np.append(categories.get_indexer(part.categories), -1)
+        codes.append(remap[part.codes])
+    return pd.Categorical.from_codes(np.concatenate(codes) if codes else [],
+                                     categories=categories)
+
+# Parsed segments are cached in a directory next to the source file, holding one .npy
+# file per column and a metadata file. String columns are stored as int32 codes plus
+# their distinct values. Numeric columns are stored as decoded, before the requested
+# dtypes are applied, so that a cache written by a single precision run still serves
+# double precision callers.
+CACHE_SUFFIX = ".cache"
+CACHE_VERSION = 2
+CACHE_META_FILE = "meta.json"
+
+def _source_signature(file_name):
+    '''Size and modification time of a source file. The cache is only valid while
+    both are unchanged.'''
+    stat = os.stat(file_name)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _read_segment_cache(file_name, columns, dtypes):
+    '''Load the cached columns of a segment, memory-mapping numeric columns. String
+    columns with a categorical dtype are rebuilt from their cached codes without
+    decoding them. Returns None if there is no valid cache holding all requested
+    columns, or if a cached numeric column is narrower than its requested dtype.'''
+    cache_dir = file_name + CACHE_SUFFIX
+    try:
+        with open(os.path.join(cache_dir, CACHE_META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != CACHE_VERSION or \
+       meta.get("source") != _source_signature(file_name):
+        return None
+    if columns is None:
+        columns = meta["columns"]
+    if any(column not in meta["columns"] for column in columns):
+        return None
+    for column in columns:
+        cached, requested = meta["dtypes"].get(column), dtypes.get(column)
+        if cached is not None and requested not in (None, "category") and \
+           np.dtype(cached).kind == np.dtype(requested).kind and \
+           np.dtype(cached).itemsize < np.dtype(requested).itemsize:
+            return None
+
+    data = dict()
+    for column in columns:
+        values = np.load(os.path.join(cache_dir, column + ".npy"), mmap_mode="r")
+        if column in meta["strings"] and dtypes.get(column) == "category":
+            values = pd.Categorical.from_codes(np.asarray(values),
+                                               categories=pd.Index(meta["strings"][column]))
+        elif column in meta["strings"]:
+            # A code of -1 marks a missing value and picks the trailing None.
+            distinct = np.asarray(meta["strings"][column] + [None], dtype=object)
+            values = distinct[values]
+        data[column] = values
+    return pd.DataFrame(data, columns=columns)
+
+def _write_segment_cache(file_name, frame):
+    '''Write a parsed segment to its cache directory. The directory is built under a
+    temporary name and renamed into place, so readers never see a partial cache.'''
+    cache_dir = file_name + CACHE_SUFFIX
+    temp_dir = "{}.tmp{}".format(cache_dir, os.getpid())
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    meta = {"version": CACHE_VERSION, "source": _source_signature(file_name),
+            "columns": list(frame.columns), "strings": dict(), "dtypes": dict()}
+    for column in frame.columns:
+        if pd.api.types.is_numeric_dtype(frame[column]):
+            values = frame[column].to_numpy()
+            meta["dtypes"][column] = values.dtype.str
+        else:
+            codes, distinct = pd.factorize(frame[column])
+            values = codes.astype(np.int32)
+            meta["strings"][column] = [str(value) for value in distinct]
+        np.save(os.path.join(temp_dir, column + ".npy"), values)
+    with open(os.path.join(temp_dir, CACHE_META_FILE), "w") as meta_file:
+        json.dump(meta, meta_file)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(temp_dir, cache_dir)
+
+def _read_json_segment(file_name, columns, dtypes, cache="use", since=None, until=None,
+                       validate=False):
+    '''Parse a single json lines segment, decoding only the requested columns. Numeric
+    and categorical dtypes are applied right away so that the per-segment frames stay
+    small; categories are unified when the segments are concatenated.
+    With cache="use" a valid columnar cache is loaded instead of parsing json, and
+    written after parsing otherwise; "rebuild" always parses and rewrites the cache, and
+    "off" neither reads nor writes it. Only revisions with since <= timestamp < until
+    are kept; the cache always holds the whole segment. With validate, the decoded
+    columns are checked with validate_records.
+    Defined at module level so that it can be shipped to worker processes.'''
+    if cache == "use":
+        frame = _read_segment_cache(file_name, columns, dtypes)
+        if frame is not None:
+            if validate:
+                validate_records(frame, file_name)
+            frame = _apply_numeric_schema(frame, columns, dtypes)
+            return _apply_categorical_schema(_select_time_range(frame, since, until), dtypes)
+    with open(file_name, "rb") as json_file:
+        frame = _decode_json_lines(json_file.read().splitlines(), columns)
+    if validate:
+        validate_records(frame, file_name)
+    if cache != "off":
+        try:
+            _write_segment_cache(file_name, frame)
+        except OSError:
+            # A read-only data directory only costs us the speed-up.
+            pass
+    frame = _apply_numeric_schema(frame, columns, dtypes)
+    return _apply_categorical_schema(_select_time_range(frame, since, until), dtypes)
 
 class Loader:
     '''
@@ -29,8 +349,10 @@ class Loader:
             self.df: the dataframe that combines all loaded data files. Keeps
                      the common columns and all rows.
         Public Methods:
-            load_json: loads json files.
+            load_json: loads json files, either by repeated outer merge or by a single
+                       concatenation deduplicated on revision_id.
             load_csv: loads csv files.
+            iter_json_chunks: yields json records in bounded-size chunks without keeping them.
             get_data: returns the loaded in-memory object. Defaults to Pandas Dataframe.
     '''
 
@@ -41,30 +363,135 @@ class Loader:
 
     def _get_file_names(self, file_path_format_str, range_start, range_end):
         '''Get the file names of data files using the input pattern, starting index and ending
-        index. Replace "##" placeholder with two-digit number. '''
+        index. Replace the "##" placeholder with the zero-padded index; a longer run of "#",
+        e.g. "#####", pads to as many digits. '''
+        width = len(self.placeholder)
+        while self.placeholder[0] * (width + 1) in file_path_format_str:
+            width += 1
         data_file_names = []
         for i in range(range_start, range_end):
-            if i < 10:
-                data_file_names.append(file_path_format_str.replace(self.placeholder, "0"+str(i)))
-            else:
-                data_file_names.append(file_path_format_str.replace(self.placeholder, str(i)))
+            data_file_names.append(file_path_format_str.replace(self.placeholder[0] * width,
+                                                                str(i).zfill(width)))
         return data_file_names
 
 
-    def load_json(self, file_path_format_str, range_start, range_end, out_format="df"):
+    def _concat_frames(self, frames, dtypes):
+        '''Concatenate parsed segments in a single pass and drop duplicated revisions.
+        Categorical columns are concatenated on their codes, so that all segments share
+        one dictionary of strings.'''
+        categorical = [column for column, dtype in dtypes.items()
+                       if dtype == "category" and column in frames[0].columns]
+        df = pd.concat([frame.drop(columns=categorical) for frame in frames],
+                       ignore_index=True)
+        for column in categorical:
+            df[column] = combine_categoricals([frame[column] for frame in frames])
+        df = df[list(frames[0].columns)]
+        if "revision_id" in df.columns:
+            df = df.drop_duplicates(subset="revision_id", keep="first", ignore_index=True)
+        return df
+
+    def _read_json_segments(self, data_file_names, columns, dtypes, workers, cache,
+                            since=None, until=None, validate=False):
+        '''Parse all segments, optionally with a pool of worker processes. The returned
+        frames are always in the order of data_file_names, regardless of which worker
+        finishes first, so the combined frame is deterministic.'''
+        if workers <= 1 or len(data_file_names) <= 1:
+            return [_read_json_segment(file_name, columns, dtypes, cache, since, until,
+                                       validate)
+                    for file_name in data_file_names]
+        workers = min(workers, len(data_file_names))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_read_json_segment, data_file_names,
+                                     [columns] * len(data_file_names),
+                                     [dtypes] * len(data_file_names),
+                                     [cache] * len(data_file_names),
+                                     [since] * len(data_file_names),
+                                     [until] * len(data_file_names),
+                                     [validate] * len(data_file_names)))
+
+    def load_json(self, file_path_format_str, range_start, range_end, out_format="df",
+                  mode="merge", columns=None, dtypes=None, workers=1, cache="use",
+                  since=None, until=None, validate=False):
         '''Load a batch of json data files. Always assume record layout: the file must
-        be formatted like {col1->val, col2->val}, {col1->val, col2->val}, ... '''
+        be formatted like {col1->val, col2->val}, {col1->val, col2->val}, ...
+        With mode="merge", every file is outer-merged into the combined frame; timestamps
+        are kept as epoch seconds, like in concat mode. With
+        mode="concat", all files are read first, concatenated once and deduplicated on
+        revision_id; columns and dtypes then default to DEFAULT_COLUMNS and DEFAULT_DTYPES,
+        and segments are parsed by up to `workers` processes. Parsed segments are cached
+        next to their source file; cache is one of "use", "rebuild" or "off". In concat
+        mode, only revisions with since <= timestamp < until (epoch seconds) are kept,
+        and each segment is filtered before the segments are combined. Only the requested
+        columns are decoded, and with validate every segment is checked against
+        RECORD_SCHEMA.'''
         data_file_names = self._get_file_names(file_path_format_str, range_start, range_end)
 
-        if out_format == "df":
-            for file_name in data_file_names:
-                current_frame = pd.read_json(path_or_buf=file_name,
-                                             orient="records", typ="frame", lines=True)
-                if self.df is None:
-                    self.df = current_frame
-                else:
-                    self.df = self.df.merge(right=current_frame, how="outer")
+        if out_format != "df":
+            return
+
+        if mode == "concat":
+            if columns is None:
+                columns = DEFAULT_COLUMNS
+            if dtypes is None:
+                dtypes = DEFAULT_DTYPES
+            frames = self._read_json_segments(data_file_names, columns, dtypes, workers, cache,
+                                              since, until, validate)
+            if self.df is not None:
+                frames.insert(0, self.df)
+            self.df = self._concat_frames(frames, dtypes)
+            return
+
+        for file_name in data_file_names:
+            # Every file is decoded to the declared schema, so all merged frames agree
+            # on their dtypes.
+            with open(file_name, "rb") as json_file:
+                current_frame = _decode_json_lines(json_file.read().splitlines(), columns)
+            if validate:
+                validate_records(current_frame, file_name)
+            if dtypes is not None:
+                current_frame = current_frame.astype(dtypes)
+            if self.df is None:
+                self.df = current_frame
+            else:
+                self.df = self.df.merge(right=current_frame, how="outer")
                     
+    def iter_json_chunks(self, file_path_format_str, range_start, range_end, chunk_size,
+                         columns=None, dtypes=None, since=None, until=None,
+                         validate=False):
+        '''Yield the records of a batch of json data files as DataFrames of at most
+        chunk_size rows. Nothing is accumulated in self.df, so memory is bounded by the
+        chunk size plus the revision ids seen so far. Columns and dtypes default to
+        DEFAULT_COLUMNS and DEFAULT_DTYPES; categorical dtypes are not applied since
+        categories would differ between chunks. Like in concat mode, duplicated revisions
+        are dropped, keeping the first, within and across files. Only revisions with
+        since <= timestamp < until are yielded, and with validate every chunk is checked
+        against RECORD_SCHEMA.'''
+        if columns is None:
+            columns = DEFAULT_COLUMNS
+        if dtypes is None:
+            dtypes = DEFAULT_DTYPES
+        # Sorted revision ids of all yielded rows.
+        seen = np.zeros(0, dtype=np.int64)
+        for file_name in self._get_file_names(file_path_format_str, range_start, range_end):
+            with open(file_name, "rb") as json_file:
+                while True:
+                    lines = list(itertools.islice(json_file, chunk_size))
+                    if not lines:
+                        break
+                    chunk = _decode_json_lines(lines, columns)
+                    if validate:
+                        validate_records(chunk, file_name)
+                    chunk = _select_time_range(_apply_numeric_schema(chunk, columns, dtypes),
+                                               since, until)
+                    if "revision_id" in chunk.columns:
+                        revision_ids = chunk["revision_id"].to_numpy(dtype=np.int64)
+                        repeated = pd.Series(revision_ids).duplicated().to_numpy() | \
+                                   np.isin(revision_ids, seen)
+                        seen = np.union1d(seen, revision_ids)
+                        if repeated.any():
+                            chunk = chunk[~repeated].reset_index(drop=True)
+                    yield chunk
+
     def load_csv(self, file_path_format_str, range_start, range_end, out_format="df"):
         '''Load a batch of csv files'''
 
@@ -0,0 +1,152 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/6/2020
+    Batched plotting of per-group figures. Instead of building a new figure for every
+    group, a single figure is kept and only the data of its artists is replaced between
+    groups. Small groups can also be drawn as tiles of a shared sheet.
+
+'''
+import matplotlib
+# Figures are only ever written to files, never shown.
+matplotlib.use("Agg")
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import numpy as np
+
+# Number of histogram bins of the distribution plots.
+HISTOGRAM_BINS = 20
+# Size in inches of the figure of a single group: half of the 18.5 x 10.5 figures of
+# --plot-mode figure. Encoding the png and drawing the ticks take most of the time of
+# a figure and both grow with its size.
+FIGURE_SIZE = (9.25, 5.25)
+
+class GroupPlotter:
+    '''
+        Group Plotter Class. Draws one kind of per-group figure ("distribution" histograms
+        or "evolution" line plots), with one axes per column, reusing a single figure.
+        Instance Variables:
+            kind: "distribution" or "evolution".
+            columns: the columns plotted for each group.
+            out_dir: directory the figures are saved to.
+            tiles: None to save one figure per group, or (rows, cols) to draw that many
+                   groups as tiles of one sheet.
+            figure, axes: the reused figure, and its axes per tile and column.
+            artists: the reused artists per tile and column, bar patches or a line.
+        Public Methods:
+            plot: draws the data of one group.
+            finish: saves a partially filled sheet and releases the figure.
+    '''
+
+    def __init__(self, kind, columns, out_dir, tiles=None):
+        self.kind = kind
+        self.columns = list(columns)
+        self.out_dir = out_dir
+        self.tiles = tiles
+        self.figure = None
+        self.axes = None
+        self.artists = None
+        self._tile = 0
+        self._sheet_name = None
+
+    def _tile_count(self):
+        return 1 if self.tiles is None else self.tiles[0] * self.tiles[1]
+
+    def _build(self):
+        '''Create the figure and one set of artists per tile and column.'''
+        rows, cols = (1, 1) if self.tiles is None else self.tiles
+        self.figure, axes = plt.subplots(rows, cols * len(self.columns), squeeze=False)
+        if self.tiles is None:
+            self.figure.set_size_inches(*FIGURE_SIZE)
+        else:
+            self.figure.set_size_inches(3.0 * cols * len(self.columns), 2.5 * rows)
+        self.axes = [list(axes[tile // cols][(tile % cols) * len(self.columns):
+                                             (tile % cols + 1) * len(self.columns)])
+                     for tile in range(rows * cols)]
+        if self.kind == "evolution":
+            # The axes are built before any data, so the date axis is set up explicitly;
+            # otherwise timestamps show as raw day numbers.
+            for ax in axes.flat:
+                ax.xaxis_date()
+        if self.tiles is not None:
+            # Tick labels dominate the drawing time of a sheet, so tiles get only a few.
+            for ax in axes.flat:
+                if self.kind == "evolution":
+                    # With minticks=2, spans of a minute or two fit no tick interval
+                    # and AutoDateLocator warns.
+                    ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=1, maxticks=4))
+                    ax.locator_params(axis="y", nbins=3)
+                else:
+                    ax.locator_params(nbins=3)
+                ax.tick_params(labelsize="xx-small")
+        self.artists = []
+        for tile_axes in self.axes:
+            tile_artists = []
+            for ax in tile_axes:
+                if self.kind == "distribution":
+                    tile_artists.append(ax.bar(np.zeros(HISTOGRAM_BINS),
+                                               np.zeros(HISTOGRAM_BINS), align="edge"))
+                else:
+                    tile_artists.append(ax.plot([], [])[0])
+            self.artists.append(tile_artists)
+
+    def _draw(self, ax, artist, values, times):
+        if self.kind == "distribution":
+            heights, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+            for patch, height, left, right in zip(artist, heights, edges[:-1], edges[1:]):
+                patch.set_x(left)
+                patch.set_width(right - left)
+                patch.set_height(height)
+            ax.set_xlim(edges[0], edges[-1])
+            ax.set_ylim(0, max(heights.max(), 1) * 1.05)
+        else:
+            artist.set_data(times, values)
+            ax.relim()
+            ax.autoscale_view()
+
+    def plot(self, group_key, file_name, titles, values, times=None):
+        '''Draw one group. values holds the data of each column, times the matching
+        x values for evolution plots. Each figure is saved under
+        out_dir/<file_name>.png; sheets of tiles are named after their first group.'''
+        if self.figure is None:
+            self._build()
+        if self._tile == 0:
+            self._sheet_name = file_name
+        for ax, artist, title, column_values in zip(self.axes[self._tile],
+                                                    self.artists[self._tile],
+                                                    titles, values):
+            ax.set_visible(True)
+            self._draw(ax, artist, column_values, times)
+            ax.set_title(title, fontsize=None if self.tiles is None else "x-small")
+        self._tile += 1
+        if self._tile == self._tile_count():
+            self._save()
+
+    def _save(self):
+        for tile_axes in self.axes[self._tile:]:
+            for ax in tile_axes:
+                ax.set_visible(False)
+        suffix = "" if self.tiles is None else "_sheet"
+        self.figure.savefig("{}/{}{}.png".format(self.out_dir, self._sheet_name, suffix))
+        self._tile = 0
+
+    def finish(self):
+        '''Save the last, partially filled sheet and close the figure.'''
+        if self.figure is None:
+            return
+        if self._tile > 0:
+            self._save()
+        plt.close(self.figure)
+        self.figure = None
@@ -0,0 +1,119 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/10/2020
+    Timing instrumentation of analysis pipelines. Records wall time, rows processed and
+    memory change of every stage, and the slowest groups of every per-key task.
+
+'''
+import contextlib
+import heapq
+import json
+import os
+import resource
+import time
+
+def current_rss_mb():
+    '''Current resident set size of this process in megabytes. Falls back to the peak
+    resident set size where /proc is not available.'''
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class StageProfiler:
+    '''
+        Stage Profiler Class. Collects timings of pipeline stages and per-group tasks.
+        Instance Variables:
+            slowest_count: number of slowest groups kept per task.
+            stages: list of recorded stages, in the order they finished. Each stage is a
+                    dict with name, seconds, rows and memory_delta_mb, which is None
+                    where the memory change was not measured.
+            slowest_groups: maps each task name to a min-heap of its slowest groups, as
+                            (seconds, group index, group key, rows) tuples.
+        Public Methods:
+            stage: context manager timing a stage.
+            add_stage: records a stage timed elsewhere.
+            record_group: records the time one task spent on one group.
+            report: formats all recorded timings as text.
+            to_dict: returns all recorded timings as a json-compatible dict.
+            dump_json: writes to_dict to a file.
+    '''
+
+    def __init__(self, slowest_count=10):
+        self.slowest_count = slowest_count
+        self.stages = []
+        self.slowest_groups = dict()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        '''Time the enclosed block as a stage. The yielded dict can be updated, e.g. to
+        set the number of rows once it is known.'''
+        record = {"name": name, "rows": rows}
+        memory_before = current_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["memory_delta_mb"] = current_rss_mb() - memory_before
+            self.stages.append(record)
+
+    def add_stage(self, name, seconds, rows=0, memory_delta_mb=None):
+        '''Record a stage whose time was measured by the caller. Its memory change is
+        left blank unless the caller measured it too.'''
+        self.stages.append({"name": name, "rows": rows, "seconds": seconds,
+                            "memory_delta_mb": memory_delta_mb})
+
+    def record_group(self, task_name, index, group_key, seconds, rows):
+        '''Record the time a task spent on a group, keeping only the slowest ones.'''
+        heap = self.slowest_groups.setdefault(task_name, [])
+        entry = (seconds, index, str(group_key), rows)
+        if len(heap) < self.slowest_count:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def to_dict(self):
+        '''All recorded timings as a json-compatible dict.'''
+        return {"stages": [dict(stage) for stage in self.stages],
+                "slowest_groups": {
+                    task_name: [{"seconds": seconds, "index": index, "key": key,
+                                 "rows": rows}
+                                for seconds, index, key, rows in sorted(heap, reverse=True)]
+                    for task_name, heap in self.slowest_groups.items()}}
+
+    def report(self):
+        '''Format all recorded timings as a text table.'''
+        lines = ["{:<40}{:>10}{:>12}{:>14}".format("stage", "seconds", "rows",
+                                                   "memory MB")]
+        for stage in self.stages:
+            memory = "" if stage["memory_delta_mb"] is None else \
+                     "{:+.1f}".format(stage["memory_delta_mb"])
+            lines.append("{:<40}{:>10.3f}{:>12}{:>14}".format(
+                stage["name"], stage["seconds"], stage["rows"], memory))
+        for task_name, groups in self.to_dict()["slowest_groups"].items():
+            lines.append("Slowest groups of {}:".format(task_name))
+            for group in groups:
+                lines.append("    {:>10.4f}s {:>8} rows  {}".format(
+                    group["seconds"], group["rows"], group["key"]))
+        return "\n".join(lines)
+
+    def dump_json(self, path):
+        '''Write all recorded timings to a json file.'''
+        with open(path, "w") as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
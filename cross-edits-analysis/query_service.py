@@ -0,0 +1,295 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/20/2020
+    Local HTTP/JSON query service. Loads the dataset, builds the group index and detects
+    the window anomalies once, then answers queries about keys until stopped.
+
+    Usage:
+    $ python3 query_service.py article --path ./data/1023/segment-000##-of-00037.json --start 0 --stop 37 --port 8080
+    $ curl "http://127.0.0.1:8080/stats?key=Valerie%20Malone"
+    $ curl "http://127.0.0.1:8080/anomalies?key=Valerie%20Malone"
+    $ curl "http://127.0.0.1:8080/top?n=10&metric=median"
+
+'''
+
+import sys
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import urllib.parse
+import numpy as np
+import pandas as pd
+import anomaly_sink
+import engine
+
+# Key column of each supported key.
+KEY_COLUMNS = {"article": "title", "author": "author"}
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+class LRUCache:
+    '''
+        Result cache with least recently used eviction.
+        Instance Variables:
+            capacity: maximum number of cached results.
+            entries: the cached results, from least to most recently used.
+            hits, misses: lookup counters.
+        Public Methods:
+            get: looks up a result, marking it as most recently used.
+            put: stores a result, evicting the least recently used one if full.
+    '''
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, request):
+        '''Return the cached result of request, or None.'''
+        if request not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(request)
+        return self.entries[request]
+
+    def put(self, request, result):
+        '''Cache the result of request.'''
+        if self.capacity <= 0:
+            return
+        self.entries[request] = result
+        self.entries.move_to_end(request)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+def _json_value(value):
+    '''Plain python value of numpy scalars, with NaN as None.'''
+    if isinstance(value, dict):
+        return {name: _json_value(item) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    return value
+
+class QueryService:
+    '''
+        Query Service Class. Keeps an analysed Engine resident and answers json queries
+        over HTTP. Requests are handled by an asyncio server; queries that miss the
+        cache run one at a time on a worker thread, so the event loop keeps accepting
+        connections while the engine computes.
+        Instance Variables:
+            engine: the Engine holding the dataset, with its key set.
+            cache: LRUCache of query results.
+            anomalies: the window anomalies of all keys, in log order, with a "window"
+                       column telling fixed windows ("fixed") from time windows
+                       ("time"). Fixed windows come first within a key.
+            anomaly_offsets: anomalies of group g are rows
+                             anomaly_offsets[g]:anomaly_offsets[g + 1].
+        Public Methods:
+            prepare: builds the group index and detects the window anomalies.
+            query: answers a request path such as /stats?key=...
+            serve: runs the HTTP server until cancelled.
+    '''
+
+    def __init__(self, analysis_engine, cache_size=256):
+        self.engine = analysis_engine
+        self.cache = LRUCache(cache_size)
+        self.anomalies = None
+        self.anomaly_offsets = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = dict()
+
+    def prepare(self):
+        '''Build the group index and detect the fixed window anomalies of every key, and
+        with --time-window the time window anomalies too. Anomaly log lines are not
+        written anywhere; the service answers from the returned frames.'''
+        self.engine.build_group_index()
+        self.engine.anomaly_sink = anomaly_sink.AnomalySink(open(os.devnull, "w"))
+        self.engine.time_window_sink = anomaly_sink.AnomalySink(open(os.devnull, "w"))
+        anomalies = [self.engine.detect_window_anomalies().assign(window="fixed")]
+        if self.engine.time_window:
+            anomalies.append(self.engine.detect_time_window_anomalies().assign(window="time"))
+        anomalies = pd.concat(anomalies, ignore_index=True)
+        _, group_keys, _ = self.engine.group_index
+        codes = group_keys.get_indexer(np.asarray(anomalies["key"], dtype=object))
+        order = np.argsort(codes, kind="stable")
+        self.anomalies = anomalies.iloc[order].reset_index(drop=True)
+        self.anomaly_offsets = np.searchsorted(codes[order], np.arange(len(group_keys) + 1))
+
+    def _group_number(self, key):
+        _, group_keys, _ = self.engine.group_index
+        number = group_keys.get_indexer([key])[0]
+        if number < 0:
+            raise KeyError(key)
+        return number
+
+    def _stats(self, key):
+        sorted_df, group_keys, offsets = self.engine.group_index
+        number = self._group_number(key)
+        group = sorted_df.iloc[offsets[number]:offsets[number + 1]]
+        return self.engine.group_stats(group, group_keys[number], number)
+
+    def _anomaly_records(self, frame):
+        return [{"key": str(key), "column": column, "metric": metric, "start": int(start),
+                 "end": int(end), "percent_diff": round(float(percent_diff), 4),
+                 "window": window}
+                for key, column, metric, start, end, percent_diff, window in
+                frame[anomaly_sink.FIELDS + ["window"]].itertuples(index=False, name=None)]
+
+    def _key_anomalies(self, key):
+        number = self._group_number(key)
+        rows = self.anomalies.iloc[self.anomaly_offsets[number]:
+                                   self.anomaly_offsets[number + 1]]
+        return {"key": key, "anomalies": self._anomaly_records(rows)}
+
+    def _top(self, count, column=None, metric=None, window=None):
+        '''The count keys with the most anomalous windows, optionally of one column,
+        metric and kind of window, with their largest percent difference.'''
+        anomalies = self.anomalies
+        if window is not None:
+            anomalies = anomalies[anomalies["window"] == window]
+        if column is not None:
+            anomalies = anomalies[anomalies["column"] == column]
+        if metric is not None:
+            anomalies = anomalies[anomalies["metric"] == metric]
+        per_key = anomalies.groupby("key", observed=True, sort=False)["percent_diff"].agg(
+            ["size", "max"])
+        per_key = per_key.sort_values(["size", "max"], ascending=False, kind="stable")
+        return {"keys": [{"key": str(key), "anomaly_count": int(size),
+                          "max_percent_diff": round(float(largest), 4)}
+                         for key, size, largest in
+                         per_key.head(count).itertuples(name=None)]}
+
+    def _health(self):
+        return {"key": self.engine.key, "rows": int(self.engine.df.shape[0]),
+                "groups": int(self.engine.group_count),
+                "anomalies": int(self.anomalies.shape[0]),
+                "cache": {"size": len(self.cache.entries), "capacity": self.cache.capacity,
+                          "hits": self.cache.hits, "misses": self.cache.misses}}
+
+    def query(self, target):
+        '''Answer the request target, e.g. "/top?n=5". Returns (status, result).'''
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if url.path == "/health":
+                return 200, self._health()
+            if url.path == "/stats":
+                return 200, self._stats(params["key"])
+            if url.path == "/anomalies":
+                return 200, self._key_anomalies(params["key"])
+            if url.path == "/top":
+                return 200, self._top(int(params.get("n", 10)), params.get("column"),
+                                      params.get("metric"), params.get("window"))
+        except KeyError as error:
+            if error.args and error.args[0] == "key" and "key" not in params:
+                return 400, {"error": "missing parameter key"}
+            return 404, {"error": "unknown {} {}".format(self.engine.key, error.args[0])}
+        except ValueError as error:
+            return 400, {"error": str(error)}
+        return 404, {"error": "unknown path {}".format(url.path)}
+
+    async def _answer(self, target):
+        '''Serve a query from the cache, or compute it on the worker thread. Health
+        reports are never cached.'''
+        if urllib.parse.urlsplit(target).path == "/health":
+            return self.query(target)
+        cached = self.cache.get(target)
+        if cached is not None:
+            return cached
+        # Concurrent requests for the same query wait for the one already computing it.
+        pending = self._pending.get(target)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        loop = asyncio.get_running_loop()
+        pending = self._pending[target] = loop.create_future()
+        try:
+            status, result = await loop.run_in_executor(self._executor, self.query, target)
+            body = (status, json.dumps(_json_value(result)))
+            if status == 200:
+                self.cache.put(target, body)
+            pending.set_result(body)
+        except Exception as error:
+            pending.set_exception(error)
+            raise
+        finally:
+            del self._pending[target]
+        return body
+
+    async def _handle(self, reader, writer):
+        '''Handle one HTTP/1.1 request. Only GET is supported, and every connection is
+        closed after its response.'''
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass
+            if len(request_line) != 3:
+                status, body = 400, json.dumps({"error": "malformed request"})
+            elif request_line[0] != "GET":
+                status, body = 405, json.dumps({"error": "only GET is supported"})
+            else:
+                status, body = await self._answer(request_line[1])
+                if not isinstance(body, str):
+                    body = json.dumps(_json_value(body))
+            payload = body.encode("utf-8")
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+                         "Content-Length: {}\r\nConnection: close\r\n\r\n".format(
+                             status, HTTP_REASONS[status], len(payload)).encode("latin-1"))
+            writer.write(payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080, ready=None):
+        '''Serve requests until cancelled. ready, if given, is called with the bound
+        (host, port) once the server listens; port 0 picks a free port.'''
+        server = await asyncio.start_server(self._handle, host, port)
+        address = server.sockets[0].getsockname()[:2]
+        if ready is not None:
+            ready(address)
+        async with server:
+            await server.serve_forever()
+
+def main(argv):
+    '''Load the dataset for the key given as first argument and serve queries.'''
+    if not argv or argv[0] not in KEY_COLUMNS:
+        print("query_service.py <article|author> --path <pattern_of_path_to_data_files> \
+            --start <start_of_file_index_range> --stop <end_of_file_index_range> \
+            [--host <service_address>] [--port <service_port>] \
+            [--cache-size <cached_service_results>]")
+        sys.exit(2)
+    service_engine = engine.Engine()
+    service_engine.get_command_line_input(argv[1:])
+    service_engine.set_key(argv[0], KEY_COLUMNS[argv[0]])
+    service_engine.fill_in_missing_key()
+    service = QueryService(service_engine, service_engine.cache_size)
+    service.prepare()
+    print(service.engine.profiler.report())
+    try:
+        asyncio.run(service.serve(service_engine.host, service_engine.port,
+                                  lambda address: print("Serving on http://{}:{}".format(
+                                      *address), flush=True)))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
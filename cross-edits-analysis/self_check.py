@@ -0,0 +1,349 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/24/2020
+    Self-check of the query service, the incremental window state, the dataset store and
+    the decoding of ORES scores on a small synthetic dump (see benchmark.py). Every check
+    prints "ok" or "FAILED"; the exit status is 1 if any check failed.
+
+    Usage:
+    $ python3 self_check.py --rows 20000 --seed 0
+
+'''
+
+import sys
+import getopt
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import urllib.parse
+import numpy as np
+import pandas as pd
+import anomaly_sink
+import benchmark
+import dataset_store
+import engine
+import loader
+import query_service
+
+SEGMENTS = 8
+
+class CheckResults:
+    '''
+        Check Results Class. Collects the outcome of named checks.
+        Instance Variables:
+            failures: names of the failed checks.
+        Public Methods:
+            check: records and prints the outcome of one check.
+    '''
+
+    def __init__(self):
+        self.failures = []
+
+    def check(self, name, passed, detail=""):
+        '''Record the outcome of the check called name.'''
+        print("{:<60}{}".format(name, "ok" if passed else "FAILED " + str(detail)))
+        if not passed:
+            self.failures.append(name)
+
+def _load_engine(file_path_format_str, start, stop, key, extra_args=()):
+    '''An Engine holding segments [start, stop) of the dump, keyed on key, writing its
+    anomaly log to memory.'''
+    analysis_engine = engine.Engine()
+    with contextlib.redirect_stdout(io.StringIO()):
+        analysis_engine.get_command_line_input(
+            ["--path", file_path_format_str, "--start", str(start), "--stop", str(stop),
+             "--no-cache"] + list(extra_args))
+    analysis_engine.set_key(key, query_service.KEY_COLUMNS[key])
+    analysis_engine.fill_in_missing_key()
+    analysis_engine.anomaly_sink = anomaly_sink.AnomalySink(io.StringIO())
+    return analysis_engine
+
+def _anomaly_set(anomalies):
+    '''Anomalies as a set of records, with percent differences rounded so that sums
+    taken in another order compare equal.'''
+    return {(str(key), column, metric, int(start), int(end), round(float(percent_diff), 6))
+            for key, column, metric, start, end, percent_diff in
+            anomalies[anomaly_sink.FIELDS].itertuples(index=False, name=None)}
+
+def _request(address, method, target):
+    '''Send one request to the service and return (status, decoded json body).'''
+    connection = http.client.HTTPConnection(*address, timeout=30)
+    try:
+        connection.request(method, target)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode("utf-8"))
+    finally:
+        connection.close()
+
+def _raw_request(address, data):
+    '''Send raw bytes to the service and return the status code of its response.'''
+    with socket.create_connection(address, timeout=30) as connection:
+        connection.sendall(data)
+        status_line = connection.makefile("rb").readline().decode("latin-1")
+    return int(status_line.split()[1])
+
+def check_query_service(results, file_path_format_str):
+    '''Serve the article analysis on a free local port and query every endpoint.'''
+    service = query_service.QueryService(
+        _load_engine(file_path_format_str, 0, SEGMENTS, "article"), cache_size=2)
+    service.prepare()
+    _, group_keys, offsets = service.engine.group_index
+    sizes = np.diff(offsets)
+    largest = str(group_keys[int(np.argmax(sizes))])
+
+    loop = asyncio.new_event_loop()
+    bound = []
+    ready = threading.Event()
+    serving = loop.create_task(service.serve(
+        "127.0.0.1", 0, lambda address: (bound.append(address), ready.set())))
+
+    def run():
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(serving)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        results.check("service listens on port 0", ready.wait(30))
+        address = bound[0]
+        quoted = urllib.parse.quote(largest)
+
+        status, stats = _request(address, "GET", "/stats?key=" + quoted)
+        results.check("/stats of the largest article", status == 200 and
+                      stats["edit_count"] == int(sizes.max()), (status, stats))
+
+        status, body = _request(address, "GET", "/anomalies?key=" + quoted)
+        expected = sorted((record[1:] for record in _anomaly_set(service.anomalies)
+                           if record[0] == largest))
+        returned = sorted((record["column"], record["metric"], record["start"],
+                           record["end"]) for record in body.get("anomalies", []))
+        results.check("/anomalies of the largest article", status == 200 and returned ==
+                      [record[:4] for record in expected], status)
+
+        status, body = _request(address, "GET", "/top?n=3&metric=median")
+        counts = [entry["anomaly_count"] for entry in body.get("keys", [])]
+        medians = service.anomalies[service.anomalies["metric"] == "median"]
+        top_count = int(medians.groupby("key", observed=True).size().max()) \
+                    if medians.shape[0] else None
+        results.check("/top of median anomalies", status == 200 and len(counts) <= 3 and
+                      counts == sorted(counts, reverse=True) and
+                      (not counts or counts[0] == top_count), (status, counts, top_count))
+
+        for target, expected_status in [("/stats", 400), ("/top?n=many", 400),
+                                        ("/stats?key=No%20such%20article", 404),
+                                        ("/unknown", 404)]:
+            status, _ = _request(address, "GET", target)
+            results.check("GET {} is {}".format(target, expected_status),
+                          status == expected_status, status)
+        status, _ = _request(address, "POST", "/health")
+        results.check("POST is 405", status == 405, status)
+        results.check("malformed request line is 400",
+                      _raw_request(address, b"GET\r\n\r\n") == 400)
+
+        # The cache holds 2 results: a third query evicts the least recently used one.
+        targets = ["/top?n=1", "/top?n=2", "/top?n=3"]
+        for target in targets:
+            _request(address, "GET", target)
+        results.check("LRU cache evicts the least recently used result",
+                      list(service.cache.entries) == targets[1:],
+                      list(service.cache.entries))
+        hits = service.cache.hits
+        _request(address, "GET", targets[1])
+        results.check("LRU cache serves a repeated query", service.cache.hits == hits + 1 and
+                      list(service.cache.entries) == [targets[2], targets[1]])
+        status, health = _request(address, "GET", "/health")
+        results.check("/health reports the dataset", status == 200 and
+                      health["rows"] == service.engine.df.shape[0], status)
+    finally:
+        loop.call_soon_threadsafe(serving.cancel)
+        thread.join()
+        loop.close()
+        service._executor.shutdown()
+
+    # With --time-window, time window anomalies are served next to the fixed ones.
+    timed_service = query_service.QueryService(
+        _load_engine(file_path_format_str, 0, SEGMENTS, "article", ["--time-window", "7d"]))
+    timed_service.prepare()
+    timed_service._executor.shutdown()
+    anomalies = timed_service.anomalies
+    fixed = anomalies[anomalies["window"] == "fixed"]
+    results.check("--time-window serves fixed and time window anomalies",
+                  _anomaly_set(fixed) == _anomaly_set(service.anomalies) and
+                  (anomalies["window"] == "time").any())
+    status, body = timed_service.query("/top?n=1&window=time")
+    results.check("/top of time window anomalies", status == 200 and
+                  body["keys"][0]["anomaly_count"] == int(
+                      anomalies[anomalies["window"] == "time"].groupby(
+                          "key", observed=True).size().max()), (status, body))
+
+def check_state_store(results, file_path_format_str, temp_dir):
+    '''Analyse the dump by author in two incremental runs and compare them with a run
+    over the whole dump. Authors edit across segments, so the second run adds edits to
+    keys of the first.'''
+    state_path = os.path.join(temp_dir, "state.npz")
+    half = SEGMENTS // 2
+    first_run = _load_engine(file_path_format_str, 0, half, "author",
+                             ["--state", state_path])
+    first = _anomaly_set(first_run.update_window_anomalies())
+    first_only = _load_engine(file_path_format_str, 0, half, "author")
+    results.check("first incremental run equals a full run",
+                  first == _anomaly_set(first_only.detect_window_anomalies()))
+
+    second_run = _load_engine(file_path_format_str, half, SEGMENTS, "author",
+                              ["--state", state_path])
+    second = _anomaly_set(second_run.update_window_anomalies())
+    full_run = _load_engine(file_path_format_str, 0, SEGMENTS, "author")
+    full = _anomaly_set(full_run.detect_window_anomalies())
+    results.check("second run only flags windows of the full run", second <= full,
+                  len(second - full))
+
+    # Timestamps of the new non-zero edits of every author.
+    frame = second_run.df
+    new_edits = frame[frame["ores_damaging"] != 0]
+    new_times = {str(key): np.sort(times.to_numpy()) for key, times in
+                 new_edits.groupby("author", observed=True)["timestamp"]}
+    results.check("second run only flags authors with new edits",
+                  {record[0] for record in second} <= set(new_times))
+    missed = [record for record in full if record[0] in new_times and
+              np.any((new_times[record[0]] >= record[3]) &
+                     (new_times[record[0]] <= record[4])) and record not in second]
+    results.check("second run flags every window holding a new edit", not missed,
+                  len(missed))
+    # Scanning starts at the first window holding a new edit, except for authors whose
+    # windows changed: those with at most one earlier edit, or that now reach the window
+    # size.
+    old_edits = first_run.df[first_run.df["ores_damaging"] != 0]
+    old_counts = old_edits.groupby("author", observed=True).size()
+    window_size = second_run.window_size
+    rescanned = {key for key, times in new_times.items()
+                 if old_counts.get(key, 0) <= 1 or
+                 (old_counts.get(key, 0) < window_size <= old_counts.get(key, 0) + len(times))}
+    unchanged = [record for record in second if record[0] not in rescanned and
+                 record[4] < new_times[record[0]][0]]
+    results.check("second run skips windows before the new edits", not unchanged,
+                  len(unchanged))
+
+    repeated_run = _load_engine(file_path_format_str, half, SEGMENTS, "author",
+                                ["--state", state_path])
+    results.check("repeated run finds no new edits",
+                  repeated_run.update_window_anomalies().shape[0] == 0)
+
+def check_dataset_store(results, file_path_format_str, temp_dir):
+    '''Append segments to a store, including after an interrupted write, and compare the
+    opened store with the parsed segments.'''
+    root = os.path.join(temp_dir, "store")
+    try:
+        dataset_store.DatasetStore(root).open()
+        results.check("empty store is rejected", False)
+    except ValueError:
+        results.check("empty store is rejected", True)
+    file_names = [file_path_format_str.replace("##", "{:02d}".format(segment))
+                  for segment in range(2)]
+    store = dataset_store.DatasetStore(root)
+    store.add_segment("synthetic", file_names[0])
+    results.check("stored segment is skipped", store.add_segment("synthetic",
+                                                                 file_names[0]) == 0)
+
+    # An interrupted writer leaves bytes past the committed end of every file.
+    for name in os.listdir(root):
+        if name.endswith((".bin", ".strings")):
+            with open(os.path.join(root, name), "ab") as data_file:
+                data_file.write(b"\x07" * 13)
+    store = dataset_store.DatasetStore(root)
+    store.add_segment("synthetic", file_names[1])
+
+    opened = dataset_store.DatasetStore(root).open()
+    data_loader = loader.Loader()
+    data_loader.load_json(file_path_format_str, 0, 2, mode="concat", cache="off")
+    parsed = data_loader.df.reset_index(drop=True)
+    same = list(opened.columns) == list(parsed.columns) and \
+           opened.shape == parsed.shape and \
+           all(np.array_equal(opened[column].astype(str).to_numpy(),
+                              parsed[column].astype(str).to_numpy())
+               for column in parsed.columns)
+    results.check("store recovers from an interrupted write", same)
+
+    store = dataset_store.DatasetStore(root)
+    opened = store.open()
+    results.check("opened numeric columns share the store maps",
+                  all(np.shares_memory(opened[column].to_numpy(), store._column(column))
+                      for column in ["revision_id", "timestamp", "ores_damaging"]))
+
+    os.utime(file_names[0], ns=(0, 0))
+    try:
+        store.add_segment("synthetic", file_names[0])
+        results.check("changed stored segment is rejected", False)
+    except ValueError:
+        results.check("changed stored segment is rejected", True)
+
+def check_float_decoding(results, file_path_format_str):
+    '''Decode a segment like the loader and compare its ORES scores with pandas' json
+    reader. Fails if a pandas release changes how it rounds decimals.'''
+    results.check("pandas' json reader rounds decimals like _pandas_float",
+                  loader.pandas_rounding_matches())
+    file_name = file_path_format_str.replace("##", "00")
+    with open(file_name, "rb") as segment:
+        decoded = loader._decode_json_lines(segment.read().splitlines(),
+                                            loader.SCORE_FIELDS)
+    expected = pd.read_json(file_name, orient="records", typ="frame", lines=True,
+                            convert_dates=False)
+    results.check("decoded scores equal pandas' json reader",
+                  all(np.array_equal(decoded[field].to_numpy(dtype=np.float64),
+                                     expected[field].to_numpy(dtype=np.float64))
+                      for field in loader.SCORE_FIELDS))
+
+def main(argv):
+    '''Generate a synthetic dump and run all checks on it.'''
+    rows, seed = 20000, 0
+    try:
+        opts, _ = getopt.getopt(argv, "", ["rows=", "seed="])
+    except getopt.GetoptError:
+        print("self_check.py [--rows <revisions>] [--seed <seed>]")
+        sys.exit(2)
+
+    for option, value in opts:
+        if option == "--rows":
+            rows = int(value)
+        elif option == "--seed":
+            seed = int(value)
+
+    results = CheckResults()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Few authors, so that most of them edit in every half of the dump.
+        file_path_format_str = benchmark.generate_segments(
+            temp_dir, rows, max(rows // 10, 1), max(rows // 40, 1), segments=SEGMENTS,
+            seed=seed)
+        for check, args in [(check_query_service, ()), (check_state_store, (temp_dir,)),
+                            (check_dataset_store, (temp_dir,)), (check_float_decoding, ())]:
+            try:
+                check(results, file_path_format_str, *args)
+            except Exception as error:
+                results.check(check.__name__ + " completes", False, repr(error))
+    print("{} checks failed".format(len(results.failures)) if results.failures
+          else "All checks passed")
+    sys.exit(1 if results.failures else 0)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,156 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/13/2020
+    Mergeable quantile sketches, used to approximate per-key medians without keeping all
+    values. Sketches built from different segments or worker processes can be merged.
+
+'''
+import numpy as np
+import pandas as pd
+
+class KLLSketch:
+    '''
+        KLL quantile sketch (Karnin, Lang and Liberty, 2016). Values are kept in levels of
+        compactors; a value at level h stands for 2^h input values. When a level is full
+        it is sorted and every other value, starting at a random offset, is promoted to
+        the next level. The rank error of a quantile is about 1.7 / k of the number of
+        values with high probability, and memory is O(k) values. As long as no level has
+        been compacted, i.e. for up to k values, all quantiles are exact.
+        Instance Variables:
+            k: size of the largest compactor. Larger k means less error and more memory.
+            count: number of values added.
+            levels: compactor contents, levels[h] holding values of weight 2^h.
+        Public Methods:
+            update: adds an array of values.
+            merge: adds the contents of another sketch.
+            quantile: estimates the q-quantile.
+            median: estimates the median.
+    '''
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.count = 0
+        self.levels = [np.zeros(0, dtype=np.float64)]
+        # Compaction offsets come from a seeded generator so that runs are repeatable.
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if values.shape[0] <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(np.zeros(0, dtype=np.float64))
+            values = np.sort(values)
+            # An odd value out stays behind so that the total weight is preserved.
+            leftover = values[:values.shape[0] % 2]
+            values = values[values.shape[0] % 2:]
+            promoted = values[self._rng.integers(2)::2]
+            self.levels[level] = leftover
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            # Capacities shrink as levels are added, so check again from the bottom.
+            level = 0
+
+    def update(self, values):
+        '''Add an array of values. Missing values are ignored. Returns the sketch.'''
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self.count += values.shape[0]
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        '''Add the contents of another sketch. Returns the sketch.'''
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.zeros(0, dtype=np.float64))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        '''Estimate the q-quantile: the smallest kept value whose cumulative weight
+        reaches q of the total weight. NaN for an empty sketch.'''
+        if self.count == 0:
+            return np.nan
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(values.shape[0], 2 ** level, dtype=np.int64)
+                                  for level, values in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative, q * cumulative[-1])
+        return values[order][min(position, values.shape[0] - 1)]
+
+    def median(self):
+        '''Estimate the median. While the sketch still holds every value, the exact
+        median is returned, averaging the two middle values for even counts.'''
+        if self.count == 0:
+            return np.nan
+        if len(self.levels) == 1:
+            return float(np.median(self.levels[0]))
+        return float(self.quantile(0.5))
+
+class KeyedQuantileSketch:
+    '''
+        One KLLSketch per key, for approximate per-key medians of one column.
+        Instance Variables:
+            k: compactor size of the per-key sketches.
+            sketches: maps each key to its KLLSketch.
+        Public Methods:
+            update: folds a chunk of (key, value) pairs into the sketches.
+            merge: folds another KeyedQuantileSketch into this one.
+            median: per-key median estimates.
+    '''
+
+    def __init__(self, k=200):
+        self.k = k
+        self.sketches = dict()
+
+    def update(self, keys, values):
+        '''Fold a chunk of values into the sketches. keys and values must be aligned
+        array-likes of the same length.'''
+        codes, uniques = pd.factorize(np.asarray(keys, dtype=object))
+        values = np.asarray(values, dtype=np.float64)
+        order = np.argsort(codes, kind="stable")
+        offsets = np.zeros(len(uniques) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)), out=offsets[1:])
+        values = values[order[np.count_nonzero(codes < 0):]]
+        for code, key in enumerate(uniques):
+            sketch = self.sketches.get(key)
+            if sketch is None:
+                sketch = self.sketches[key] = KLLSketch(self.k)
+            sketch.update(values[offsets[code]:offsets[code + 1]])
+
+    def merge(self, other):
+        '''Fold the sketches of another KeyedQuantileSketch into this one.'''
+        for key, other_sketch in other.sketches.items():
+            sketch = self.sketches.get(key)
+            if sketch is None:
+                sketch = self.sketches[key] = KLLSketch(self.k)
+            sketch.merge(other_sketch)
+
+    def median(self, keys):
+        '''Median estimate of each of the given keys, NaN for keys without values.'''
+        return np.array([self.sketches[key].median() if key in self.sketches else np.nan
+                         for key in keys], dtype=np.float64)
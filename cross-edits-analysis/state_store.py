@@ -0,0 +1,174 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/1/2020
+    Per-key state persisted between runs of the incremental sliding window analysis.
+    When new data segments arrive, only the keys they touch are re-analysed.
+
+'''
+import os
+import numpy as np
+import pandas as pd
+
+class WindowStateStore:
+    '''
+        Window State Store Class. Keeps the non-zero edits of every key, sorted by
+        (key, timestamp), together with the per-key baselines derived from them.
+        Instance Variables:
+            key_column_name: the key column the state was built for.
+            columns: the analysed columns.
+            window_size: the sliding window size the state was built for.
+            keys: list of keys, indexed by key code.
+            offsets: edits of key code k are rows offsets[k] to offsets[k + 1].
+            timestamps, revision_ids: per-edit arrays.
+            values: maps each column to its per-edit values. These are the median inputs.
+        Public Methods:
+            load: loads a saved state, or starts an empty one.
+            save: writes the state and its per-key baselines to a .npz file.
+            add_edits: merges new edits and returns the layout of the keys they touch.
+            edit_count: number of edits per key.
+            last_timestamp: timestamp of the latest edit per key.
+            baseline_mean: mean of a column per key.
+    '''
+
+    def __init__(self, key_column_name, columns, window_size):
+        self.key_column_name = key_column_name
+        self.columns = list(columns)
+        self.window_size = window_size
+        self.keys = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.timestamps = np.zeros(0, dtype=np.int64)
+        self.revision_ids = np.zeros(0, dtype=np.int64)
+        self.values = {column: np.zeros(0, dtype=np.float64) for column in self.columns}
+
+    @classmethod
+    def load(cls, path, key_column_name, columns, window_size):
+        '''Load the state saved at path, or return an empty state if there is none. A
+        state built for another key, other columns or another window size is rejected.'''
+        store = cls(key_column_name, columns, window_size)
+        if not os.path.exists(path):
+            return store
+        with np.load(path) as saved:
+            if str(saved["key_column_name"]) != key_column_name or \
+               list(saved["columns"]) != store.columns or \
+               int(saved["window_size"]) != window_size:
+                raise ValueError("State file {} was built for a different analysis".format(path))
+            store.keys = [str(key) for key in saved["keys"]]
+            store.offsets = saved["offsets"]
+            store.timestamps = saved["timestamps"]
+            store.revision_ids = saved["revision_ids"]
+            store.values = {column: saved["values_" + column] for column in store.columns}
+        return store
+
+    def save(self, path):
+        '''Write the state to path. The per-key edit count, last timestamp and baseline
+        means are stored alongside for inspection. The file is replaced atomically.'''
+        arrays = {"key_column_name": np.array(self.key_column_name),
+                  "columns": np.array(self.columns, dtype=str),
+                  "window_size": np.array(self.window_size),
+                  "keys": np.array(self.keys, dtype=str),
+                  "offsets": self.offsets,
+                  "timestamps": self.timestamps,
+                  "revision_ids": self.revision_ids,
+                  "edit_count": self.edit_count(),
+                  "last_timestamp": self.last_timestamp()}
+        for column in self.columns:
+            arrays["values_" + column] = self.values[column]
+            arrays["baseline_mean_" + column] = self.baseline_mean(column)
+        temp_path = "{}.tmp{}.npz".format(path, os.getpid())
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    def edit_count(self):
+        '''Number of stored edits per key code.'''
+        return np.diff(self.offsets)
+
+    def last_timestamp(self):
+        '''Timestamp of the latest edit per key code, -1 for keys without edits.'''
+        counts = self.edit_count()
+        last = np.full(len(self.keys), -1, dtype=np.int64)
+        has_edits = counts > 0
+        last[has_edits] = self.timestamps[self.offsets[1:][has_edits] - 1]
+        return last
+
+    def baseline_mean(self, column):
+        '''Mean of column per key code, NaN for keys without edits.'''
+        counts = self.edit_count()
+        codes = np.repeat(np.arange(len(self.keys)), counts)
+        sums = np.bincount(codes, weights=self.values[column], minlength=len(self.keys))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def _codes_of(self, keys):
+        '''Key codes of an array of keys, registering keys seen for the first time.'''
+        codes = pd.Index(self.keys, dtype=object).get_indexer(keys)
+        unseen = codes < 0
+        if unseen.any():
+            new_codes, new_keys = pd.factorize(keys[unseen])
+            codes[unseen] = new_codes + len(self.keys)
+            self.keys.extend(new_keys)
+        return codes
+
+    def add_edits(self, keys, timestamps, revision_ids, values):
+        '''Merge new edits into the state. Edits whose revision is already stored are
+        dropped. Returns (codes, timestamps, values, keys, first_window): all edits of the
+        keys touched by new edits, sorted by (key code, timestamp), and for every key
+        code the position of the first window that holds a new edit. A key whose window
+        size changes, because it reached window_size edits, or that had no windows yet is
+        rescanned from the start.'''
+        keep = ~np.isin(revision_ids, self.revision_ids)
+        _, first_seen = np.unique(revision_ids, return_index=True)
+        unique = np.zeros(revision_ids.shape[0], dtype=bool)
+        unique[first_seen] = True
+        keep &= unique
+
+        old_count = self.edit_count()
+        new_codes = self._codes_of(np.asarray(keys, dtype=object)[keep])
+        old_codes = np.repeat(np.arange(len(old_count)), old_count)
+        all_codes = np.concatenate([old_codes, new_codes])
+        all_timestamps = np.concatenate([self.timestamps, timestamps[keep]])
+        is_new = np.concatenate([np.zeros(old_codes.shape[0], dtype=bool),
+                                 np.ones(new_codes.shape[0], dtype=bool)])
+        # Stable sort: on equal timestamps, stored edits stay in front of new ones.
+        order = np.lexsort((all_timestamps, all_codes))
+        all_codes = all_codes[order]
+        is_new = is_new[order]
+        self.timestamps = all_timestamps[order]
+        self.revision_ids = np.concatenate([self.revision_ids, revision_ids[keep]])[order]
+        for column in self.columns:
+            self.values[column] = np.concatenate([self.values[column],
+                                                  values[column][keep]])[order]
+        counts = np.bincount(all_codes, minlength=len(self.keys))
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+        # Position of the first new edit of every key; keys without new edits get the
+        # key size, so none of their windows are scanned.
+        position = np.arange(all_codes.shape[0]) - self.offsets[all_codes]
+        first_new = counts.copy()
+        np.minimum.at(first_new, all_codes[is_new], position[is_new])
+        old_count = np.concatenate([old_count, np.zeros(len(self.keys) - len(old_count),
+                                                        dtype=old_count.dtype)])
+        window = np.where(counts >= self.window_size, self.window_size, 1)
+        rescan = (old_count <= 1) | \
+                 ((old_count < self.window_size) & (counts >= self.window_size))
+        first_window = np.where(rescan, 0, np.maximum(first_new - window + 1, 0))
+
+        touched = np.zeros(len(self.keys), dtype=bool)
+        touched[all_codes[is_new]] = True
+        rows = touched[all_codes]
+        return (all_codes[rows], self.timestamps[rows],
+                {column: self.values[column][rows] for column in self.columns},
+                self.keys, first_window)
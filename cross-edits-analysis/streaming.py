@@ -0,0 +1,184 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 6/24/2020
+    Incremental, mergeable statistics for analysing data that does not fit in memory.
+    Data is fed chunk by chunk; only a fixed amount of state is kept per key, so memory
+    depends on the number of keys and not on the number of revisions.
+
+'''
+import numpy as np
+import pandas as pd
+
+class KeyedStreamingStats:
+    '''
+        Running statistics of one numeric column, kept separately for every key.
+        Count, mean, standard deviation and zero-count are exact (Chan et al. parallel
+        update of mean and sum of squared deviations). The median and the histogram come
+        from a fixed-bin histogram sketch, which is mergeable; the median error is at
+        most one bin width, i.e. (value_range[1] - value_range[0]) / bins.
+        Instance Variables:
+            bins: number of histogram bins.
+            value_range: (low, high) range covered by the histogram. Values outside the
+                         range are counted in the first or last bin.
+            keys: list of keys in the order they were first seen.
+            count, mean, m2, zero_count: per-key arrays, aligned with keys.
+            histogram: per-key bin counts, of shape (len(keys), bins).
+        Public Methods:
+            update: folds a chunk of (key, value) pairs into the state.
+            merge: folds another KeyedStreamingStats into this one.
+            std: per-key sample standard deviation.
+            median: per-key median estimated from the histogram sketch.
+            bin_edges: edges of the histogram bins.
+            to_frame: per-key summary as a DataFrame indexed by key.
+    '''
+
+    def __init__(self, bins=100, value_range=(0.0, 1.0)):
+        self.bins = bins
+        self.value_range = value_range
+        self.keys = []
+        self._index = dict()
+        self._size = 0
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0, dtype=np.float64)
+        self.m2 = np.zeros(0, dtype=np.float64)
+        self.zero_count = np.zeros(0, dtype=np.int64)
+        self.histogram = np.zeros((0, bins), dtype=np.uint32)
+
+    def _grow(self, size):
+        '''Make room for at least size keys, doubling capacity to amortise copies.'''
+        capacity = self.count.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 16)
+        extra = capacity - self.count.shape[0]
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.mean = np.concatenate([self.mean, np.zeros(extra, dtype=np.float64)])
+        self.m2 = np.concatenate([self.m2, np.zeros(extra, dtype=np.float64)])
+        self.zero_count = np.concatenate([self.zero_count, np.zeros(extra, dtype=np.int64)])
+        self.histogram = np.concatenate([self.histogram,
+                                         np.zeros((extra, self.bins), dtype=np.uint32)])
+
+    def _rows_for(self, keys):
+        '''Return the state row of each key, registering keys seen for the first time.'''
+        rows = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            row = self._index.get(key)
+            if row is None:
+                row = len(self.keys)
+                self._index[key] = row
+                self.keys.append(key)
+            rows[i] = row
+        self._grow(len(self.keys))
+        self._size = len(self.keys)
+        return rows
+
+    def _bin_of(self, values):
+        low, high = self.value_range
+        bin_index = np.floor((values - low) / (high - low) * self.bins).astype(np.int64)
+        return np.clip(bin_index, 0, self.bins - 1)
+
+    def _combine(self, rows, count, mean, m2, zero_count, histogram):
+        '''Merge partial summaries (one entry per row) into the running state.'''
+        count_a = self.count[rows]
+        total = count_a + count
+        delta = mean - self.mean[rows]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(total > 0, count / total, 0.0)
+        self.mean[rows] += delta * weight
+        self.m2[rows] += m2 + delta * delta * count_a * weight
+        self.count[rows] = total
+        self.zero_count[rows] += zero_count
+        self.histogram[rows] += histogram.astype(np.uint32)
+
+    def update(self, keys, values):
+        '''Fold a chunk of values into the state. keys and values must be aligned
+        array-likes of the same length. Missing values are ignored.'''
+        values = np.asarray(values, dtype=np.float64)
+        keys = np.asarray(keys, dtype=object)
+        valid = ~np.isnan(values)
+        values = values[valid]
+        keys = keys[valid]
+        if values.shape[0] == 0:
+            return
+        codes, uniques = pd.factorize(keys)
+        group_count = len(uniques)
+        rows = self._rows_for(uniques)
+
+        count = np.bincount(codes, minlength=group_count)
+        mean = np.bincount(codes, weights=values, minlength=group_count) / count
+        deviation = values - mean[codes]
+        m2 = np.bincount(codes, weights=deviation * deviation, minlength=group_count)
+        zero_count = np.bincount(codes, weights=(values == 0), minlength=group_count)
+        histogram = np.zeros((group_count, self.bins), dtype=np.int64)
+        np.add.at(histogram, (codes, self._bin_of(values)), 1)
+
+        self._combine(rows, count, mean, m2, zero_count.astype(np.int64), histogram)
+
+    def merge(self, other):
+        '''Fold the state of another KeyedStreamingStats with the same bins into this one.'''
+        if other.bins != self.bins or tuple(other.value_range) != tuple(self.value_range):
+            raise ValueError("Cannot merge sketches with different bins or value ranges")
+        if not other.keys:
+            return
+        size = len(other.keys)
+        rows = self._rows_for(other.keys)
+        self._combine(rows, other.count[:size], other.mean[:size], other.m2[:size],
+                      other.zero_count[:size], other.histogram[:size])
+
+    def std(self, ddof=1):
+        '''Per-key standard deviation, NaN for keys with too few values.'''
+        count = self.count[:self._size]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > ddof, np.sqrt(self.m2[:self._size] / (count - ddof)),
+                            np.nan)
+
+    def _value_at_rank(self, rank):
+        '''Per-key estimate of the value of the given 0-based rank. The value is placed
+        inside the bin holding that rank, assuming values are spread evenly in the bin.
+        Zeros are counted exactly, so ranks that fall on zeros are exact.'''
+        histogram = self.histogram[:self._size].astype(np.int64)
+        cumulative = np.cumsum(histogram, axis=1)
+        bin_index = np.minimum((cumulative <= rank[:, None]).sum(axis=1), self.bins - 1)
+        rows = np.arange(self._size)
+        below = np.where(bin_index > 0, cumulative[rows, np.maximum(bin_index - 1, 0)], 0)
+        in_bin = histogram[rows, bin_index]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(in_bin > 0, (rank - below + 0.5) / in_bin, 0.5)
+        edges = self.bin_edges()
+        value = edges[bin_index] + fraction * (edges[1] - edges[0])
+        return np.where(rank < self.zero_count[:self._size], 0.0, value)
+
+    def median(self):
+        '''Per-key median. Like pandas, the two middle values are averaged for even counts;
+        each of them is estimated within one bin width.'''
+        count = self.count[:self._size]
+        lower = self._value_at_rank((count - 1) // 2)
+        upper = self._value_at_rank(count // 2)
+        return np.where(count > 0, (lower + upper) / 2.0, np.nan)
+
+    def bin_edges(self):
+        '''Edges of the histogram bins, suitable for plt.stairs.'''
+        return np.linspace(self.value_range[0], self.value_range[1], self.bins + 1)
+
+    def to_frame(self):
+        '''Per-key summary as a DataFrame indexed by key.'''
+        size = self._size
+        return pd.DataFrame({"count": self.count[:size],
+                             "mean": self.mean[:size],
+                             "median": self.median(),
+                             "std": self.std(),
+                             "zero_count": self.zero_count[:size]},
+                            index=pd.Index(self.keys, dtype=object))
@@ -0,0 +1,75 @@
+'''
+    Copyright 2020 Google LLC
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        https://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Date: 7/15/2020
+    Time index of edits, sorted once by (key, timestamp), so that the time series of a key
+    is a slice of the index and trailing time windows are found by binary search.
+
+'''
+import numpy as np
+import pandas as pd
+
+def parse_time(value):
+    '''Epoch seconds of a command line time, given either as epoch seconds or as a
+    date/time string such as 2019-01-31 or 2019-01-31T12:00. Times without a time
+    zone are read as UTC, like the timestamps of the dumps.'''
+    if value.lstrip("-").isdigit():
+        return int(value)
+    return pd.Timestamp(value).value // 10 ** 9
+
+def parse_span(value):
+    '''Length in seconds of a command line time span, given either as seconds or as a
+    duration string such as 24h, 90min or 7d.'''
+    if value.isdigit():
+        return int(value)
+    return int(pd.Timedelta(value).total_seconds())
+
+class TemporalIndex:
+    '''
+        Temporal Index Class. Edits sorted by (key code, timestamp), with group offsets.
+        Instance Variables:
+            group_keys: the key of each key code.
+            codes, timestamps: key code and timestamp of each edit, in index order.
+            rows: caller-provided row of each edit, e.g. its row in the data frame,
+                  in index order.
+            offsets: the edits of key code g are positions offsets[g]:offsets[g + 1].
+        Public Methods:
+            trailing_window_starts: first edit of the trailing time window ending at
+                                    each edit.
+    '''
+
+    def __init__(self, codes, timestamps, group_keys, rows=None):
+        codes = np.asarray(codes, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        order = np.lexsort((timestamps, codes))
+        self.group_keys = group_keys
+        self.codes = codes[order]
+        self.timestamps = timestamps[order]
+        self.rows = order if rows is None else np.asarray(rows)[order]
+        self.offsets = np.zeros(len(group_keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.codes, minlength=len(group_keys)), out=self.offsets[1:])
+
+    def trailing_window_starts(self, span):
+        '''For every edit, the index position of the first edit of the same key with
+        timestamp > timestamp of the edit - span, i.e. the start of the trailing window
+        of length span ending at that edit. All windows are found with one binary
+        search over (key code, timestamp) composite keys.'''
+        if self.timestamps.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+        low = self.timestamps.min()
+        # Wide enough that subtracting span never reaches into the previous key.
+        width = self.timestamps.max() - low + span + 1
+        composite = self.codes * width + (self.timestamps - low)
+        return np.searchsorted(composite, composite - span, "right")